@@ -1,72 +1,573 @@
-from dulwich.lru_cache import LRUCache
+from dulwich.objects import ShaFile
+import collections
+import binascii
+import struct
+import json
+import zlib
+import mmap
+import threading
+import itertools
+import time
+import sys
+import logging
 
-class LocalCache(LRUCache):
+log = logging.getLogger('herodb.cache')
+
+class SizedLRUCache(object):
+    """
+    A thread safe LRU cache bounded by both entry count and total size in bytes.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None, compute_size=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compute_size = compute_size
+        self.bytes = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
 
     def __contains__(self, key):
-        return self.get(key, None) is not None
+        return key in self._cache
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': self.size(),
+            'bytes': self.bytes,
+        }
 
     def size(self):
         return len(self._cache)
 
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._cache[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = self.compute_size(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._cache[key] = (value, size)
+            self.bytes += size
+            while len(self._cache) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+                (evicted_key, (evicted, evicted_size)) = self._cache.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def remove(self, key):
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def evict_oldest(self, keep=None):
+        """
+        Evicts the least recently used entry other than keep, returning False if there
+        is none.
+        """
+        with self._lock:
+            for key in self._cache:
+                if key != keep:
+                    break
+            else:
+                return False
+            (value, size) = self._cache.pop(key)
+            self.bytes -= size
+            self.evictions += 1
+            return True
+
+class LocalCache(object):
+    """
+    A thread safe LRU cache of query results bounded by entry count and estimated
+    size in bytes.  Keys are spread over shards that each have their own lock, so
+    concurrent requests rarely wait on each other.  The byte limit applies to all
+    shards together, so any result up to max_bytes can be cached; when it is passed,
+    the oldest entries of the largest shards are evicted.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64*1024*1024, shards=16):
+        self.max_bytes = max_bytes
+        self.shards = [SizedLRUCache(max(1, max_entries // shards), None, estimate_size) for i in range(shards)]
+        self._evict_lock = threading.Lock()
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def size(self):
+        return sum(shard.size() for shard in self.shards)
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
     def set(self, key, value):
-        self.add(key, value)
+        size = estimate_size(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        self._shard(key).set(key, value, size)
+        if self.max_bytes and self.bytes() > self.max_bytes:
+            self._shrink(key)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
 
     def remove(self, key):
-        self.add(key, None)
+        self._shard(key).remove(key)
+
+    def bytes(self):
+        return sum(shard.bytes for shard in self.shards)
+
+    def _shrink(self, keep):
+        with self._evict_lock:
+            while self.bytes() > self.max_bytes:
+                for shard in sorted(self.shards, key=lambda shard: shard.bytes, reverse=True):
+                    if shard.evict_oldest(keep):
+                        break
+                else:
+                    return
+
+    def reset_stats(self):
+        for shard in self.shards:
+            shard.reset_stats()
+
+    def get_stats(self):
+        stats = {}
+        for shard in self.shards:
+            for (k, v) in shard.get_stats().iteritems():
+                stats[k] = stats.get(k, 0) + v
+        return stats
+
+def estimate_size(value):
+    """
+    Approximates the memory used by a query result made of dicts, lists, tuples,
+    strings and numbers.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for (k, v) in value.iteritems():
+            size += estimate_size(k) + estimate_size(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += estimate_size(v)
+    return size
+
+class ObjectCache(SizedLRUCache):
+    """
+    Cache of parsed git objects keyed by sha.  Objects are immutable so entries never
+    need to be invalidated, but callers must copy an object before changing it.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64*1024*1024):
+        super(ObjectCache, self).__init__(max_entries, max_bytes, lambda obj: obj.raw_length())
+
+class SharedObjectCache(object):
+    """
+    Cache of raw git objects in an anonymous shared memory map, so processes forked
+    after it is created share one warm cache.  The map is split into slot_size slots
+    and every sha maps to a single slot, so setting an object replaces whatever the
+    slot held.  Objects that don't fit in a slot aren't cached.  Slots aren't locked
+    across processes; instead get() checks the object it read against its sha, so a
+    slot torn by concurrent writers reads as a miss.
+    """
+    header = struct.Struct('>20sBI')
+
+    def __init__(self, max_bytes=256*1024*1024, slot_size=4096):
+        self.slot_size = slot_size
+        self.slots = max(1, max_bytes // slot_size)
+        self.map = mmap.mmap(-1, self.slots * slot_size)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'slots': self.slots,
+        }
+
+    def get(self, sha):
+        offset = self._offset(sha)
+        (raw_sha, type_num, length) = self.header.unpack_from(self.map, offset)
+        if raw_sha == binascii.unhexlify(sha) and length <= self.slot_size - self.header.size:
+            start = offset + self.header.size
+            try:
+                obj = ShaFile.from_raw_string(type_num, self.map[start:start + length])
+                if obj.id == sha:
+                    self.hits += 1
+                    return obj
+            except Exception:
+                pass
+        self.misses += 1
+        return None
+
+    def set(self, sha, obj):
+        data = obj.as_raw_string()
+        if len(data) > self.slot_size - self.header.size:
+            return
+        offset = self._offset(sha)
+        start = offset + self.header.size
+        self.map[start:start + len(data)] = data
+        self.map[offset:start] = self.header.pack(binascii.unhexlify(sha), obj.type_num, len(data))
+        self.sets += 1
+
+    def _offset(self, sha):
+        return (int(sha[:8], 16) % self.slots) * self.slot_size
+
+class ValueCache(SizedLRUCache):
+    """
+    Cache of deserialized values keyed by (serializer, blob sha).  Cached values are
+    shared between callers, so mode controls what callers get back: 'frozen' returns
+    read only values (tuples instead of lists and FrozenDict instead of dict) and None
+    returns the shared value itself.  'copy' only caches immutable values; dicts and
+    lists are parsed again from the blob, which is cheaper than deep copying them.
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=64*1024*1024, mode='copy'):
+        super(ValueCache, self).__init__(max_entries, max_bytes)
+        if mode not in ('copy', 'frozen', None):
+            raise ValueError("Unknown value cache mode: %s" % mode)
+        self.mode = mode
+
+    def set(self, key, value, size=None):
+        if self.mode == 'frozen':
+            value = freeze(value)
+        elif self.mode == 'copy' and isinstance(value, (dict, list)):
+            return value
+        super(ValueCache, self).set(key, value, size)
+        return value
+
+class FrozenDict(dict):
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenDict does not support item assignment")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.iteritems())))
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+class JsonCodec(object):
+    id = 1
+
+    def encode(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def decode(self, data):
+        return json.loads(data)
+
+class MsgpackCodec(object):
+    id = 2
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def encode(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+codecs = {
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+class CacheEncoding(object):
+    """
+    Encodes cached values for shared caches as a header, which holds the format
+    version, the codec id and whether the payload is compressed, followed by the
+    codec's payload.  Payloads longer than compress_threshold bytes are compressed
+    with zlib.  Entries written with another format version or codec decode to None
+    so they are treated as misses rather than misread.
+    """
+    version = 1
+    header = struct.Struct('>BBB')
+    COMPRESSED = 1
+
+    def __init__(self, codec=None, compress_threshold=1024):
+        self.codec = codec or JsonCodec()
+        self.compress_threshold = compress_threshold
+
+    def encode(self, value):
+        data = self.codec.encode(value)
+        flags = 0
+        if self.compress_threshold is not None and len(data) > self.compress_threshold:
+            data = zlib.compress(data)
+            flags |= self.COMPRESSED
+        return self.header.pack(self.version, self.codec.id, flags) + data
+
+    def decode(self, data):
+        if data is None or len(data) < self.header.size:
+            return None
+        (version, codec_id, flags) = self.header.unpack_from(data)
+        if version != self.version or codec_id != self.codec.id:
+            return None
+        data = data[self.header.size:]
+        if flags & self.COMPRESSED:
+            data = zlib.decompress(data)
+        return self.codec.decode(data)
 
 class RedisCache(object):
+    """
+    Query cache backed by redis, so it can be shared by servers.  Values are encoded
+    with a CacheEncoding and keys are prefixed with its format version.
+    """
 
-    def __init__(self, connection, expire=86400):
+    def __init__(self, connection, expire=86400, codec=None, compress_threshold=1024):
         self.connection = connection
         self.expire = expire
+        self.encoding = CacheEncoding(codec, compress_threshold)
+
+    def _key(self, key):
+        return 'herodb:v%d:%s' % (self.encoding.version, json.dumps(key, separators=(',', ':')))
 
     def size(self):
         return self.connection.dbsize()
 
     def get(self, key):
-        return self.connection.get(key)
+        return self.encoding.decode(self.connection.get(self._key(key)))
+
+    def get_many(self, keys):
+        """
+        Returns the values for keys, with None for missing keys, in one MGET.
+        """
+        if not keys:
+            return []
+        return [self.encoding.decode(data) for data in self.connection.mget([self._key(k) for k in keys])]
 
     def set(self, key, value):
         with self.connection.pipeline() as pipe:
-            pipe.set(key, value)
-            pipe.expire(key, self.expire)
+            pipe.set(self._key(key), self.encoding.encode(value))
+            pipe.expire(self._key(key), self.expire)
             pipe.execute()
 
+class TieredCache(object):
+    """
+    Query cache that checks a local in-process cache before a shared one, such as a
+    RedisCache, and copies shared hits into the local tier.  Cached query results
+    are keyed by commit sha and never change, so the local tier never needs to be
+    invalidated.
+    """
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {
+                'local': {'hits': 0, 'misses': 0},
+                'shared': {'hits': 0, 'misses': 0},
+            }
+
+    def get_stats(self):
+        with self._lock:
+            return {'local': dict(self.stats['local']), 'shared': dict(self.stats['shared'])}
+
+    def size(self):
+        return self.local.size()
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local', 1)
+            return value
+        self._count('local', 0, 1)
+        value = self.shared.get(key)
+        if value is None:
+            self._count('shared', 0, 1)
+            return None
+        self._count('shared', 1)
+        self.local.set(key, value)
+        return value
+
+    def get_many(self, keys):
+        values = self.local.get_many(keys)
+        missing = [i for (i, value) in enumerate(values) if value is None]
+        self._count('local', len(keys) - len(missing), len(missing))
+        if missing:
+            shared_values = self.shared.get_many([keys[i] for i in missing])
+            found = 0
+            for (i, value) in zip(missing, shared_values):
+                if value is not None:
+                    values[i] = value
+                    self.local.set(keys[i], value)
+                    found += 1
+            self._count('shared', found, len(missing) - found)
+        return values
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        self.shared.set(key, value)
+
+    def _count(self, tier, hits, misses=0):
+        with self._lock:
+            self.stats[tier]['hits'] += hits
+            self.stats[tier]['misses'] += misses
+
 class QueryCache(object):
+    """
+    Caches query results keyed by operation and arguments.  Only queries for a given
+    commit_sha are cached, since their results never change.  Concurrent misses for
+    the same key are coalesced: the first caller runs the query and the others wait
+    for its result.  Stats are kept per operation, including an estimate of the time
+    hits saved based on the average time of that operation's misses.  Counters are
+    split into stripes, and each thread is given the next stripe the first time it
+    records, so recording a hit rarely waits on another thread.  get_stats sums them.
+    """
+    stat_stripes = 16
 
     def __init__(self, backend=None, enabled=True):
         self.backend = backend
         self.enabled = enabled
         if not self.backend:
             self.backend = LocalCache(10000)
-        self.reset_stats()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stripes = [(threading.Lock(), {}) for i in range(self.stat_stripes)]
+        self._next_stripe = itertools.count()
+        self._local = threading.local()
 
     def reset_stats(self):
-        self.requests = 0
-        self.hits = 0
-        self.misses = 0
+        if isinstance(self.backend, TieredCache):
+            self.backend.reset_stats()
+        for (lock, operations) in self._stripes:
+            with lock:
+                operations.clear()
 
     def get_stats(self):
-        return {
-            'requests': self.requests,
-            'hits': self.hits,
-            'misses': self.misses,
+        operations = {}
+        for (lock, stripe) in self._stripes:
+            with lock:
+                for (operation, counts) in stripe.iteritems():
+                    op = operations.setdefault(operation, dict.fromkeys(counts, 0))
+                    for (k, v) in counts.iteritems():
+                        op[k] += v
+        for op in operations.itervalues():
+            op['hit_rate'] = float(op['hits']) / op['requests'] if op['requests'] else 0.0
+            op['saved_seconds'] = op['hits'] * op['miss_seconds'] / op['misses'] if op['misses'] else 0.0
+        stats = {
             'size': self.backend.size(),
+            'tiers': self.backend.get_stats() if isinstance(self.backend, TieredCache) else None,
+            'operations': operations,
         }
+        for k in ('requests', 'hits', 'misses', 'coalesced', 'saved_seconds'):
+            stats[k] = sum(op[k] for op in operations.itervalues())
+        return stats
 
     def get(self, operation, commit_sha, cb, *args):
-        self.requests += 1
         if not self.enabled or not commit_sha:
+            self._record(operation, None)
             return cb(*args)
         key = (operation,) + tuple(args)
-        value = None
-        if commit_sha:
-            value = self.backend.get(key)
+        value = self.backend.get(key)
         if value is not None:
-            self.hits += 1
-        else:
-            self.misses += 1
+            self._record(operation, True)
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            self._record(operation, 'coalesced')
+            return flight.wait()
+        start = time.time()
+        try:
             value = cb(*args)
-            if commit_sha:
+        except Exception, e:
+            flight.fail(e)
+            raise
+        else:
+            flight.finish(value)
+            try:
                 self.backend.set(key, value)
+            except Exception:
+                log.exception("Failed to cache %s result" % operation)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            self._record(operation, False, time.time() - start)
         return value
+
+    def _record(self, operation, hit, elapsed=0):
+        (lock, operations) = self._stripe()
+        with lock:
+            op = operations.get(operation)
+            if op is None:
+                op = operations[operation] = {'requests': 0, 'hits': 0, 'misses': 0, 'coalesced': 0, 'miss_seconds': 0.0}
+            op['requests'] += 1
+            if hit == 'coalesced':
+                op['coalesced'] += 1
+            elif hit:
+                op['hits'] += 1
+            elif hit is not None:
+                op['misses'] += 1
+                op['miss_seconds'] += elapsed
+
+    def _stripe(self):
+        index = getattr(self._local, 'stripe', None)
+        if index is None:
+            index = self._local.stripe = next(self._next_stripe) % len(self._stripes)
+        return self._stripes[index]
+
+class Flight(object):
+    """
+    A query being run by one caller that other callers with the same key wait on.
+    """
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, value):
+        self.value = value
+        self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
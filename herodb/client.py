@@ -1,5 +1,6 @@
 import requests
 import json
+import time
 from herodb.store import ROOT_PATH
 from cache import QueryCache
 
@@ -42,6 +43,27 @@ class StoreClient(object):
         else:
             response.raise_for_status()
 
+    def get_store_stats(self):
+        response = self.session.get(self._url('store_stats'))
+        if response.status_code == requests.codes.ok:
+            return response.json()
+        else:
+            response.raise_for_status()
+
+    def get_pool_stats(self):
+        response = self.session.get(self._url('pool_stats'))
+        if response.status_code == requests.codes.ok:
+            return response.json()
+        else:
+            response.raise_for_status()
+
+    def get_commit_stats(self):
+        response = self.session.get(self._url('commit_stats'))
+        if response.status_code == requests.codes.ok:
+            return response.json()
+        else:
+            response.raise_for_status()
+
     def get_stores(self):
         response = self.session.get(self._url('stores'))
         if response.status_code == requests.codes.ok:
@@ -49,6 +71,22 @@ class StoreClient(object):
         else:
             response.raise_for_status()
 
+    def object_counts(self, store):
+        path = _build_path(store, "objects")
+        response = self.session.get(self._url(path))
+        if response.status_code == requests.codes.ok:
+            return response.json()
+        else:
+            response.raise_for_status()
+
+    def repack(self, store):
+        path = _build_path(store, "repack")
+        response = self.session.post(self._url(path))
+        if response.status_code == requests.codes.ok:
+            return response.json()
+        else:
+            response.raise_for_status()
+
     def create_branch(self, store, branch, parent=None):
         path = _build_path(store, "branch", branch)
         params = _build_params(parent=parent)
@@ -66,10 +104,10 @@ class StoreClient(object):
         else:
             response.raise_for_status()
 
-    def merge(self, store, source, target='master', author=None, committer=None):
+    def merge(self, store, source, target='master', author=None, committer=None, on_conflict=None):
         path = _build_path(store, "merge", source)
-        params = _build_params(target=target, author=author, committer=committer)
-        response = self.session.post(self._url(path), data=params)
+        params = _build_params(target=target, author=author, committer=committer, on_conflict=on_conflict)
+        response = self.session.post(self._url(path), params=params)
         if response.status_code == requests.codes.ok:
             return response.json()
         else:
@@ -99,6 +137,18 @@ class StoreClient(object):
         else:
             response.raise_for_status()
 
+    def put_many(self, store, entries, deletes=None, flatten_keys=True, branch='master', author=None, committer=None):
+        path = _build_path(store, "batch")
+        payload = json.dumps({'entries': entries, 'deletes': list(deletes or [])})
+        flatten_keys = 1 if flatten_keys else 0
+        params = _build_params(flatten_keys=flatten_keys, branch=branch, author=author, committer=committer)
+        headers = {'Content-Type': 'application/json'}
+        response = self.session.put(self._url(path), headers=headers, params=params, data=payload)
+        if response.status_code == requests.codes.ok:
+            return response.json()
+        else:
+            response.raise_for_status()
+
     def delete(self, store, key, branch='master', author=None, committer=None):
         path = _entry_path(store, key)
         params = _build_params(branch=branch, author=author, committer=committer)
@@ -108,41 +158,109 @@ class StoreClient(object):
         else:
             response.raise_for_status()
 
-    def keys(self, store, key=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, filter_by=None, branch='master', commit_sha=None):
-        def _keys(store, key, pattern, min_level, max_level, depth_first, filter_by, branch, commit_sha):
+    def keys(self, store, key=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, filter_by=None, branch='master', commit_sha=None, limit=None, after=None, glob=None):
+        def _keys(store, key, pattern, glob, min_level, max_level, depth_first, filter_by, branch, commit_sha, limit, after):
             path = _build_path(store, "keys", key)
             depth_first = 1 if depth_first else 0
-            params = _build_params(pattern=pattern, min_level=min_level, max_level=max_level, depth_first=depth_first, filter_by=filter_by, branch=branch, commit_sha=commit_sha)
+            params = _build_params(pattern=pattern, glob=glob, min_level=min_level, max_level=max_level, depth_first=depth_first, filter_by=filter_by, branch=branch, commit_sha=commit_sha, limit=limit, after=after)
             response = self.session.get(self._url(path), params=params)
             if response.status_code == requests.codes.ok:
                 return response.json()
             else:
                 response.raise_for_status()
-        return self.cache.get('keys', commit_sha, _keys, store, key, pattern, min_level, max_level, depth_first, filter_by, branch, commit_sha)
+        return self.cache.get('keys', commit_sha or after, _keys, store, key, pattern, glob, min_level, max_level, depth_first, filter_by, branch, commit_sha, limit, after)
+
+    def iter_keys(self, store, key=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, filter_by=None, branch='master', commit_sha=None, glob=None):
+        path = _build_path(store, "keys", key)
+        depth_first = 1 if depth_first else 0
+        params = _build_params(pattern=pattern, glob=glob, min_level=min_level, max_level=max_level, depth_first=depth_first, filter_by=filter_by, branch=branch, commit_sha=commit_sha, format='ndjson')
+        return self._iter_ndjson(path, params)
 
-    def entries(self, store, key=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, branch='master', commit_sha=None):
-        def _entries(store, key, pattern, min_level, max_level, depth_first, branch, commit_sha):
+    def entries(self, store, key=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, branch='master', commit_sha=None, limit=None, after=None, glob=None):
+        def _entries(store, key, pattern, glob, min_level, max_level, depth_first, branch, commit_sha, limit, after):
             path = _build_path(store, "entries", key)
             depth_first = 1 if depth_first else 0
-            params = _build_params(pattern=pattern, min_level=min_level, max_level=max_level, depth_first=depth_first, branch=branch, commit_sha=commit_sha)
+            params = _build_params(pattern=pattern, glob=glob, min_level=min_level, max_level=max_level, depth_first=depth_first, branch=branch, commit_sha=commit_sha, limit=limit, after=after)
+            response = self.session.get(self._url(path), params=params)
+            if response.status_code == requests.codes.ok:
+                return response.json()
+            else:
+                response.raise_for_status()
+        return self.cache.get('entries', commit_sha or after, _entries, store, key, pattern, glob, min_level, max_level, depth_first, branch, commit_sha, limit, after)
+
+    def iter_entries(self, store, key=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, branch='master', commit_sha=None, glob=None):
+        path = _build_path(store, "entries", key)
+        depth_first = 1 if depth_first else 0
+        params = _build_params(pattern=pattern, glob=glob, min_level=min_level, max_level=max_level, depth_first=depth_first, branch=branch, commit_sha=commit_sha, format='ndjson')
+        for entry in self._iter_ndjson(path, params):
+            yield tuple(entry)
+
+    def _iter_ndjson(self, path, params):
+        response = self.session.get(self._url(path), params=params, stream=True)
+        if response.status_code != requests.codes.ok:
+            response.raise_for_status()
+        try:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+    def diff(self, store, old_sha, new_sha=None, branch='master'):
+        def _diff(store, old_sha, new_sha, branch):
+            path = _build_path(store, "diff", old_sha)
+            params = _build_params(new_sha=new_sha, branch=branch)
             response = self.session.get(self._url(path), params=params)
             if response.status_code == requests.codes.ok:
                 return response.json()
             else:
                 response.raise_for_status()
-        return self.cache.get('entries', commit_sha, _entries, store, key, pattern, min_level, max_level, depth_first, branch, commit_sha)
+        return self.cache.get('diff', new_sha, _diff, store, old_sha, new_sha, branch)
+
+    def iter_diff(self, store, old_sha, new_sha=None, branch='master'):
+        path = _build_path(store, "diff", old_sha)
+        params = _build_params(new_sha=new_sha, branch=branch, format='ndjson')
+        for change in self._iter_ndjson(path, params):
+            yield tuple(change)
+
+    def changes(self, store, since=None, branch='master', timeout=30):
+        path = _build_path(store, "changes")
+        params = _build_params(since=since, branch=branch, timeout=timeout)
+        response = self.session.get(self._url(path), params=params)
+        if response.status_code == requests.codes.ok:
+            return response.json()
+        else:
+            response.raise_for_status()
+
+    def watch(self, store, since=None, branch='master', timeout=30):
+        """
+        Yields {'sha': ..., 'diff': ...} for every change to branch after since, or
+        after the current head if since is not given.  Each wait is a long-poll of at
+        most timeout seconds, repeated until the caller stops iterating.  Servers that
+        don't long-poll answer at once, and are polled at most once a second.
+        """
+        if not since:
+            since = self.get_branch(store, branch)['sha']
+        while True:
+            start = time.time()
+            change = self.changes(store, since, branch, timeout)
+            if change['sha'] != since:
+                since = change['sha']
+                yield change
+            else:
+                time.sleep(max(0, 1 - (time.time() - start)))
 
-    def trees(self, store, key=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, object_depth=None, branch='master', commit_sha=None):
-        def _trees(store, key, pattern, min_level, max_level, depth_first, object_depth, branch, commit_sha):
+    def trees(self, store, key=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, object_depth=None, branch='master', commit_sha=None, glob=None):
+        def _trees(store, key, pattern, glob, min_level, max_level, depth_first, object_depth, branch, commit_sha):
             path = _build_path(store, "trees", key)
             depth_first = 1 if depth_first else 0
-            params = _build_params(pattern=pattern, min_level=min_level, max_level=max_level, depth_first=depth_first, object_depth=object_depth, branch=branch, commit_sha=commit_sha)
+            params = _build_params(pattern=pattern, glob=glob, min_level=min_level, max_level=max_level, depth_first=depth_first, object_depth=object_depth, branch=branch, commit_sha=commit_sha)
             response = self.session.get(self._url(path), params=params)
             if response.status_code == requests.codes.ok:
                 return response.json()
             else:
                 response.raise_for_status()
-        return self.cache.get('trees', commit_sha, _trees, store, key, pattern, min_level, max_level, depth_first, object_depth, branch, commit_sha)
+        return self.cache.get('trees', commit_sha, _trees, store, key, pattern, glob, min_level, max_level, depth_first, object_depth, branch, commit_sha)
 
 def _entry_path(store, key):
     return _build_path(store, "entry", key)
@@ -0,0 +1,158 @@
+from store import flatten, ROOT_PATH
+from dulwich.index import pathsplit
+import collections
+import threading
+import logging
+import time
+
+log = logging.getLogger('herodb.committer')
+
+class PendingWrite(object):
+    """
+    A put or delete waiting in the commit queue.  The request thread that queued it
+    blocks in wait() until the committer thread has committed it.
+    """
+
+    def __init__(self, entries, deletes):
+        self.entries = entries
+        self.deletes = deletes
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class GroupCommitter(object):
+    """
+    Coalesces concurrent puts and deletes to the same store and branch into a single
+    commit.  Writes are queued and a single committer thread folds everything queued
+    within interval seconds, or as soon as max_ops writes are pending, into one
+    Store.put_many call per store, branch, author and committer.
+    """
+
+    def __init__(self, interval=0.05, max_ops=1000):
+        self.interval = interval
+        self.max_ops = max_ops
+        self.queues = collections.OrderedDict()
+        self.pending = 0
+        self.commits = 0
+        self.writes = 0
+        self.cond = threading.Condition()
+        t = threading.Thread(target=self._run, name='herodb-committer')
+        t.setDaemon(True)
+        t.start()
+
+    def get_stats(self):
+        return {
+            'commits': self.commits,
+            'writes': self.writes,
+            'pending': self.pending,
+        }
+
+    def put(self, store, key, value, flatten_keys=True, branch='master', author=None, committer=None, overwrite=False):
+        if overwrite:
+            # overwrites remove keys that aren't in value, which can't be folded into
+            # put_many, so they commit on their own
+            return store.put(key, value, flatten_keys, branch=branch, author=author, committer=committer, overwrite=overwrite)
+        e = {key: value}
+        if flatten_keys:
+            e = flatten(e)
+        return self._submit(store, branch, author, committer, PendingWrite(e, []))
+
+    def delete(self, store, key, branch='master', author=None, committer=None):
+        return self._submit(store, branch, author, committer, PendingWrite({}, [key]))
+
+    def _submit(self, store, branch, author, committer, write):
+        with self.cond:
+            self.queues.setdefault((store, branch, author, committer), []).append(write)
+            self.pending += 1
+            self.cond.notify()
+        return write.wait()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queues:
+                    self.cond.wait()
+                deadline = time.time() + self.interval
+                while self.pending < self.max_ops:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                queues = self.queues
+                self.queues = collections.OrderedDict()
+                self.pending = 0
+            for (store, branch, author, committer), writes in queues.iteritems():
+                for batch in _batches(writes):
+                    self._commit(store, branch, author, committer, batch)
+
+    def _commit(self, store, branch, author, committer, batch):
+        entries = {}
+        deletes = set()
+        for write in batch:
+            entries.update(write.entries)
+            deletes.update(write.deletes)
+        try:
+            result = store.put_many(entries, deletes, flatten_keys=False, branch=branch, author=author, committer=committer)
+        except Exception, e:
+            log.exception("group commit failed for store %s" % store.id)
+            for write in batch:
+                write.finish(error=e)
+            return
+        self.commits += 1
+        self.writes += len(batch)
+        for write in batch:
+            write.finish(result)
+
+def _batches(writes):
+    """
+    Splits queued writes into runs that can be applied by a single put_many call
+    without changing the result of applying them one after another.  put_many applies
+    deletes before puts, so a run ends when a write touches a key that an earlier put
+    in the same run wrote, or wrote above or below.
+    """
+    batch = []
+    keys = set()
+    dirs = set()
+    for write in writes:
+        if batch and _conflicts(write, keys, dirs):
+            yield batch
+            batch = []
+            keys = set()
+            dirs = set()
+        batch.append(write)
+        for k in write.entries:
+            keys.add(k)
+            path = k
+            while path:
+                (path, name) = pathsplit(path)
+                dirs.add(path)
+    if batch:
+        yield batch
+
+def _conflicts(write, keys, dirs):
+    for k in write.deletes:
+        if k in keys or k in dirs or k == ROOT_PATH or _has_parent_in(k, keys):
+            return True
+    for k in write.entries:
+        if k in dirs or _has_parent_in(k, keys):
+            return True
+    return False
+
+def _has_parent_in(key, keys):
+    path = key
+    while path:
+        (path, name) = pathsplit(path)
+        if path in keys:
+            return True
+    return False
@@ -0,0 +1,51 @@
+from store import create
+import argparse
+import json
+import os
+import sys
+
+def import_store():
+    parser = argparse.ArgumentParser(prog="import", add_help=False)
+    parser.add_argument("-h", "--help", action="store_true", help="""
+        show program's help text and exit
+        """.strip())
+    parser.add_argument("-b", "--branch", default="master", help="""
+        branch to commit the imported entries to
+        """.strip())
+    parser.add_argument("-m", "--message", help="""
+        commit message for the import
+        """.strip())
+    parser.add_argument("--no-flatten", action="store_true", help="""
+        store dict values as a single blob instead of one blob per nested key
+        """.strip())
+    parser.add_argument("repo_path", help="""
+        path of the store's git repo, created if it doesn't exist
+        """.strip())
+    parser.add_argument("path", help="""
+        newline delimited JSON file of [key, value] entries, or - for stdin
+        """.strip())
+    args = parser.parse_args()
+    if args.help:
+        parser.print_help()
+    else:
+        if args.path == '-':
+            f = sys.stdin
+        else:
+            f = open(args.path)
+        try:
+            store = create(os.path.basename(args.repo_path.rstrip('/')), args.repo_path)
+            result = store.bulk_import(read_entries(f), not args.no_flatten, args.branch, message=args.message)
+            print result['sha']
+        finally:
+            f.close()
+
+def read_entries(f):
+    """
+    Yields (key, value) pairs from newline delimited JSON [key, value] lines, the
+    format entries are streamed in by the server.
+    """
+    for line in f:
+        line = line.strip()
+        if line:
+            (key, value) = json.loads(line)
+            yield (key.encode('utf-8'), value)
@@ -0,0 +1,181 @@
+import Queue
+import itertools
+import threading
+
+class PoolFull(Exception):
+    """
+    Raised when a call is made while queue_size calls are already waiting for a
+    worker.
+    """
+
+class PoolTimeout(Exception):
+    """
+    Raised when a call doesn't finish within the pool's timeout.  The call itself
+    keeps running on its worker.
+    """
+
+class PendingCall(object):
+    """
+    A call waiting in the pool's queue.  The calling thread blocks in wait() until a
+    worker has run it.  A call that times out before a worker starts it is abandoned
+    and never runs, so a request that was answered with a timeout has no effect.
+    """
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.started = False
+        self.abandoned = False
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            if self.abandoned:
+                return
+            self.started = True
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception, e:
+            self.error = e
+        self.done.set()
+
+    def abandon(self):
+        """
+        Stops the call from running if no worker has started it yet.
+        """
+        with self._lock:
+            if not self.started:
+                self.abandoned = True
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            self.abandon()
+            raise PoolTimeout()
+        return self.get()
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class WorkerPool(object):
+    """
+    Bounded pool of threads that blocking store calls are handed to, so the server's
+    front end only waits on them.  At most workers calls run at once and at most
+    queue_size wait for a worker; further calls raise PoolFull.  Calls taking longer
+    than timeout seconds raise PoolTimeout.
+    """
+
+    def __init__(self, workers=10, queue_size=100, timeout=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.pending = 0
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.rejected = 0
+        self.timeouts = 0
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='herodb-worker-%d' % i)
+            t.setDaemon(True)
+            t.start()
+
+    def get_stats(self):
+        return {
+            'workers': self.workers,
+            'queued': self.queue.qsize(),
+            'calls': self.calls,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
+
+    def apply(self, fn, *args, **kwargs):
+        call = PendingCall(fn, args, kwargs)
+        with self._lock:
+            # pending counts calls running as well as queued, so a queue_size of 0
+            # allows no waiting at all
+            if self.pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise PoolFull()
+            self.pending += 1
+            self.calls += 1
+        self.queue.put(call)
+        try:
+            return call.wait(self.timeout)
+        except PoolTimeout:
+            self.timeouts += 1
+            raise
+
+    def _work(self):
+        while True:
+            self.queue.get().run()
+            with self._lock:
+                self.pending -= 1
+
+class GeventWorkerPool(WorkerPool):
+    """
+    WorkerPool for servers running on gevent.  Calls run on a gevent ThreadPool, so
+    waiting for them only blocks the calling greenlet.
+    """
+
+    def __init__(self, workers=10, queue_size=100, timeout=None):
+        from gevent.threadpool import ThreadPool
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.pool = ThreadPool(workers)
+        self.pending = 0
+        self.calls = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def get_stats(self):
+        return {
+            'workers': self.workers,
+            'queued': max(0, self.pending - self.workers),
+            'calls': self.calls,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
+
+    def apply(self, fn, *args, **kwargs):
+        import gevent
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise PoolFull()
+        self.calls += 1
+        self.pending += 1
+        call = PendingCall(fn, args, kwargs)
+        try:
+            self.pool.spawn(call.run).get(timeout=self.timeout)
+        except gevent.Timeout:
+            call.abandon()
+            self.timeouts += 1
+            raise PoolTimeout()
+        finally:
+            self.pending -= 1
+        return call.get()
+
+def iter_in_pool(pool, items, chunk=None, chunk_size=100):
+    """
+    Iterates over items, reading chunk_size items at a time on a pool worker, so
+    streamed responses don't read from the store on the server's front end.  chunk
+    is an optional first chunk that was already read with next_chunk.
+    """
+    items = iter(items)
+    while True:
+        if chunk is None:
+            chunk = pool.apply(next_chunk, items, chunk_size)
+        if not chunk:
+            break
+        for item in chunk:
+            yield item
+        chunk = None
+
+def next_chunk(items, chunk_size=100):
+    return list(itertools.islice(items, chunk_size))
@@ -0,0 +1,74 @@
+from cache import SharedObjectCache
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+def serve_prefork(stores_path, host='localhost', port=8080, processes=4, internal_port=None,
+                  shared_cache_bytes=256*1024*1024, shared_cache_slot_size=4096, quiet=False, **app_kwargs):
+    """
+    Serves stores_path from processes forked worker processes that accept on one
+    listening socket.  Each worker runs the threaded server, and they share an object
+    cache created before forking.  Every store is owned by one worker, which makes all
+    writes to it; the others forward writes to the owner on localhost at
+    internal_port + worker id (internal_port defaults to port + 1).  Workers that exit
+    are restarted.
+    """
+    if internal_port is None:
+        internal_port = port + 1
+    sock = _listen(host, port)
+    shared_cache = SharedObjectCache(shared_cache_bytes, shared_cache_slot_size)
+    children = {}
+
+    def start(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(sock, stores_path, worker_id, processes, internal_port, shared_cache, quiet, app_kwargs)
+            finally:
+                os._exit(1)
+        children[pid] = worker_id
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(processes):
+        start(worker_id)
+    while True:
+        try:
+            (pid, status) = os.wait()
+        except OSError:
+            time.sleep(1)
+            continue
+        worker_id = children.pop(pid, None)
+        if worker_id is not None:
+            logging.warning("herodb worker %d exited with status %d, restarting", worker_id, status)
+            start(worker_id)
+
+def _listen(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    return sock
+
+def _run_worker(sock, stores_path, worker_id, workers, internal_port, shared_cache, quiet, app_kwargs):
+    import server
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    server.make_app(stores_path, server_mode='threaded', worker_id=worker_id, workers=workers,
+                    internal_port=internal_port, shared_cache=shared_cache, **app_kwargs)
+    internal = _listen('localhost', internal_port + worker_id)
+    t = threading.Thread(target=server.serve_socket, args=(internal, quiet))
+    t.setDaemon(True)
+    t.start()
+    server.serve_socket(sock, quiet)
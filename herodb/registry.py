@@ -0,0 +1,134 @@
+import collections
+import threading
+import time
+
+class StoreRegistry(object):
+    """
+    Bounded registry of open Store instances.  Stores are kept in least recently used
+    order and the oldest is evicted once more than max_stores are open.  Each store is
+    constructed by a single thread; others asking for the same store while it is
+    being opened wait for it rather than opening it again.
+
+    Callers lease a store with acquire() and hand it back with release().  An evicted
+    store is only closed once its last lease is released, so requests still reading
+    from it are never cut off.
+    """
+
+    def __init__(self, max_stores=1000):
+        self.max_stores = max_stores
+        self.stores = collections.OrderedDict()
+        self.last_used = {}
+        self.opening = set()
+        self.seen = set()
+        self.leases = {}
+        self.retired = set()
+        self.cond = threading.Condition()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.opened = 0
+        self.reopened = 0
+        self.evicted = 0
+
+    def get_stats(self):
+        return {
+            'open': len(self.stores),
+            'leased': len(self.leases),
+            'hits': self.hits,
+            'opened': self.opened,
+            'reopened': self.reopened,
+            'evicted': self.evicted,
+        }
+
+    def __contains__(self, key):
+        return key in self.stores
+
+    def acquire(self, key, open_store):
+        """
+        Leases the store for key, calling open_store() to open it if it isn't open.
+        Every acquire must be matched by a release of the returned store.
+        """
+        with self.cond:
+            while True:
+                store = self.stores.pop(key, None)
+                if store is not None:
+                    self.stores[key] = store
+                    self.last_used[key] = time.time()
+                    self.hits += 1
+                    self._lease(store)
+                    return store
+                if key not in self.opening:
+                    break
+                self.cond.wait()
+            self.opening.add(key)
+        try:
+            store = open_store()
+        except:
+            with self.cond:
+                self.opening.discard(key)
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.opening.discard(key)
+            self.stores[key] = store
+            self.last_used[key] = time.time()
+            self.opened += 1
+            if key in self.seen:
+                self.reopened += 1
+            self.seen.add(key)
+            self._lease(store)
+            evicted = []
+            while len(self.stores) > self.max_stores:
+                evicted.extend(self._pop_oldest())
+            self.cond.notify_all()
+        for s in evicted:
+            s.close()
+        return store
+
+    def release(self, store):
+        """
+        Ends a lease taken with acquire(), closing the store if it was evicted while
+        leased and this was its last lease.
+        """
+        with self.cond:
+            count = self.leases[store] - 1
+            if count:
+                self.leases[store] = count
+                return
+            del self.leases[store]
+            if store not in self.retired:
+                return
+            self.retired.discard(store)
+        store.close()
+
+    def close_idle(self, max_idle):
+        """
+        Closes stores that haven't been used for max_idle seconds.
+        """
+        deadline = time.time() - max_idle
+        count = 0
+        evicted = []
+        with self.cond:
+            while self.stores and self.last_used[next(iter(self.stores))] < deadline:
+                evicted.extend(self._pop_oldest())
+                count += 1
+        for s in evicted:
+            s.close()
+        return count
+
+    def _lease(self, store):
+        self.leases[store] = self.leases.get(store, 0) + 1
+
+    def _pop_oldest(self):
+        """
+        Evicts the least recently used store and returns it in a list if it can be
+        closed now.  Leased stores are closed by their last release instead.
+        """
+        (key, store) = self.stores.popitem(last=False)
+        del self.last_used[key]
+        self.evicted += 1
+        if store in self.leases:
+            self.retired.add(store)
+            return []
+        return [store]
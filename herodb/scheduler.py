@@ -0,0 +1,117 @@
+from store import loose_object_count, write_activity
+import Queue
+import threading
+import logging
+import time
+
+log = logging.getLogger('herodb.scheduler')
+
+class GcScheduler(object):
+    """
+    Runs Store.gc across stores on a pool of worker threads.  Every interval seconds
+    stores are ranked by loose object count plus the commits made since the previous
+    cycle, and gc runs are started in that order, stagger seconds apart.  A store that
+    was written to within the last busy_window seconds is deferred by busy_window,
+    up to max_defers times, after which it is skipped until the next cycle.
+
+    open_store(name) opens a store for the scheduler's own use, rather than one shared
+    with requests, and the scheduler closes it when it is done with it.  Stores are
+    ranked and checked for recent writes through repo_path(name), without opening them.
+    """
+
+    def __init__(self, list_stores, open_store, repo_path, workers=2, interval=86400, stagger=5, busy_window=30, max_defers=10):
+        self.list_stores = list_stores
+        self.open_store = open_store
+        self.repo_path = repo_path
+        self.workers = workers
+        self.interval = interval
+        self.stagger = stagger
+        self.busy_window = busy_window
+        self.max_defers = max_defers
+        self.queue = Queue.PriorityQueue()
+        self.writes = {}
+        self.runs = 0
+        self.deferred = 0
+        self.skipped = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'runs': self.runs,
+                'deferred': self.deferred,
+                'skipped': self.skipped,
+                'failures': self.failures,
+                'pending': self.queue.qsize(),
+            }
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name='herodb-gc-%d' % i)
+            t.setDaemon(True)
+            t.start()
+        t = threading.Thread(target=self._run, name='herodb-gc')
+        t.setDaemon(True)
+        t.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.schedule()
+                self.queue.join()
+                log.info("done running gc on all repos")
+            except:
+                log.exception("Failure during repo git gc")
+            time.sleep(self.interval)
+
+    def schedule(self):
+        """
+        Queues a gc run for every store, most in need of one first.
+        """
+        ranked = sorted(self.list_stores(), key=self._rank, reverse=True)
+        start = time.time()
+        for (i, name) in enumerate(ranked):
+            self.queue.put((start + i * self.stagger, name, 0))
+        return ranked
+
+    def _rank(self, name):
+        path = self.repo_path(name)
+        writes = write_activity(path)['writes']
+        rank = loose_object_count(path) + writes - self.writes.get(name, 0)
+        self.writes[name] = writes
+        return rank
+
+    def _work(self):
+        while True:
+            (start, name, defers) = self.queue.get()
+            try:
+                delay = start - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self._gc(name, defers)
+            except:
+                with self._lock:
+                    self.failures += 1
+                log.exception("git gc failed for store %s" % name)
+            finally:
+                self.queue.task_done()
+
+    def _gc(self, name, defers):
+        if time.time() - write_activity(self.repo_path(name))['last_write'] < self.busy_window:
+            if defers < self.max_defers:
+                with self._lock:
+                    self.deferred += 1
+                self.queue.put((time.time() + self.busy_window, name, defers + 1))
+            else:
+                with self._lock:
+                    self.skipped += 1
+                log.info("skipping gc on busy store %s" % name)
+            return
+        store = self.open_store(name)
+        try:
+            store.gc()
+        finally:
+            store.close()
+        with self._lock:
+            self.runs += 1
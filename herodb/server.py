@@ -1,44 +1,96 @@
-from bottle import Bottle, run, request, abort, BaseRequest
-from store import Store, create, ROOT_PATH
-from cache import QueryCache, LocalCache, RedisCache
+from bottle import Bottle, run, request, response, abort, BaseRequest, ServerAdapter
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from SocketServer import ThreadingMixIn
+from store import Store, Glob, create, loose_object_count, set_object_cache, set_value_cache, set_mmap_cache, decode_cursor, encode_cursor, MergeConflict, ROOT_PATH
+from cache import QueryCache, LocalCache, RedisCache, TieredCache, ObjectCache, ValueCache, codecs
+from committer import GroupCommitter
+from registry import StoreRegistry
+from scheduler import GcScheduler
+from pool import WorkerPool, GeventWorkerPool, PoolFull, PoolTimeout, iter_in_pool, next_chunk
 from util import setup_logging, get_stacks
 import re
-import sys
 import types
+import itertools
 import json
 import os
+import zlib
+import socket
+import httplib
+import argparse
 import time
 import threading
 import logging
 
-stores = {}
+stores = StoreRegistry()
 app = Bottle()
 cache = None
 head_cache = None
+object_cache = None
+value_cache = None
+group_committer = None
+gc_scheduler = None
+worker_pool = None
+long_poll_pool = None
+mmap_cache = None
 log = logging.getLogger('herodb.server')
 
 @app.error(404)
 def error404(error):
     return error.output
 
-@app.post('/stores/<store>')
+@app.post('/stores/<store>', owner=True)
 def create_store(store):
     s = create(store, _get_repo_path(store))
     return {'sha': s.branch_head('master')}
 
 @app.get('/cache_stats')
 def get_cache_stats():
-    return cache.get_stats()
+    stats = cache.get_stats()
+    stats['objects'] = object_cache.get_stats()
+    stats['values'] = value_cache.get_stats()
+    if mmap_cache is not None:
+        stats['shared'] = mmap_cache.get_stats()
+    return stats
+
+@app.get('/commit_stats')
+def get_commit_stats():
+    if not group_committer:
+        return {'enabled': False}
+    stats = group_committer.get_stats()
+    stats['enabled'] = True
+    return stats
 
 @app.post('/reset_cache_stats')
 def reset_cache_stats():
     cache.reset_stats()
-    return cache.get_stats()
+    object_cache.reset_stats()
+    value_cache.reset_stats()
+    if mmap_cache is not None:
+        mmap_cache.reset_stats()
+    return get_cache_stats()
 
 @app.get('/thread_dump')
 def thread_dump():
     return get_stacks()
 
+@app.get('/store_stats')
+def get_store_stats():
+    return stores.get_stats()
+
+@app.get('/gc_stats')
+def get_gc_stats():
+    if gc_scheduler is None:
+        return {}
+    return gc_scheduler.get_stats()
+
+@app.get('/pool_stats')
+def get_pool_stats():
+    if worker_pool is None:
+        return {}
+    stats = worker_pool.get_stats()
+    stats['long_polls'] = long_poll_pool.get_stats()
+    return stats
+
 @app.get('/stores')
 def get_stores():
     stores = []
@@ -48,7 +100,15 @@ def get_stores():
             stores.append(path[:-4])
     return {'stores': stores}
 
-@app.post('/<store>/branch/<branch:path>')
+@app.get('/<store>/objects')
+def object_counts(store):
+    return _get_store(store).object_counts()
+
+@app.post('/<store>/repack', owner=True)
+def repack(store):
+    return {'packed': _get_store(store).repack()}
+
+@app.post('/<store>/branch/<branch:path>', owner=True)
 def create_branch(store, branch):
     s = _get_store(store)
     return s.create_branch(branch)
@@ -58,31 +118,38 @@ def get_branch(store, branch):
     s = _get_store(store)
     return {'branch': branch, 'sha': s.branch_head(branch)}
 
-@app.post('/<store>/merge/<source:path>')
+@app.post('/<store>/merge/<source:path>', owner=True)
 def merge(store, source):
     target    = _query_param('target', 'master')
     author    = _query_param('author')
     committer = _query_param('committer')
+    on_conflict = _query_param('on_conflict', 'theirs')
     s = _get_store(store)
-    return s.merge(source, target, author=author, committer=committer)
+    try:
+        return s.merge(source, target, author=author, committer=committer, on_conflict=on_conflict)
+    except MergeConflict, e:
+        response.status = 409
+        return {'conflicts': e.conflicts}
+    except ValueError, e:
+        abort(400, str(e))
 
 @app.get('/<store>/entry')
 @app.get('/<store>/entry/<path:path>')
 def get(store, path=ROOT_PATH):
     shallow    = _query_param('shallow', False) == 'True'  # force to actual boolean
     branch     = _get_branch()
-    commit_sha = _get_commit_sha()
+    commit_sha = _get_commit_sha(store, branch)
     def _get(store, path, shallow, branch, commit_sha):
         value = _get_store(store).get(path, shallow=shallow, branch=branch, commit_sha=commit_sha)
         if not value:
             abort(404, "Not found: %s" % path)
-        if type(value) != types.DictType:
+        if not isinstance(value, dict):
             value = json.dumps(value)
         return value
     return cache.get('get', commit_sha, _get, store, path, shallow, branch, commit_sha)
 
-@app.put('/<store>/entry')
-@app.put('/<store>/entry/<path:path>')
+@app.put('/<store>/entry', owner=True)
+@app.put('/<store>/entry/<path:path>', owner=True)
 def put(store, path=ROOT_PATH):
     content      = request.json
     if not content:
@@ -93,10 +160,26 @@ def put(store, path=ROOT_PATH):
     author       = _query_param('author')
     committer    = _query_param('committer')
     s = _get_store(store)
+    if group_committer:
+        return group_committer.put(s, path, content, flatten_keys, branch=branch, author=author, committer=committer, overwrite=overwrite)
     return s.put(path, content, flatten_keys, branch=branch, author=author, committer=committer, overwrite=overwrite)
 
-@app.delete('/<store>/entry')
-@app.delete('/<store>/entry/<path:path>')
+@app.put('/<store>/batch', owner=True)
+def put_many(store):
+    content      = request.json
+    if not content:
+        abort(500, "JSON request is empty")
+    entries      = dict((str(k), v) for k, v in content.get('entries', {}).iteritems())
+    deletes      = [str(k) for k in content.get('deletes', [])]
+    flatten_keys = _get_flatten_keys()
+    branch       = _get_branch()
+    author       = _query_param('author')
+    committer    = _query_param('committer')
+    s = _get_store(store)
+    return s.put_many(entries, deletes, flatten_keys, branch=branch, author=author, committer=committer)
+
+@app.delete('/<store>/entry', owner=True)
+@app.delete('/<store>/entry/<path:path>', owner=True)
 def delete(store, path=ROOT_PATH):
     branch    = _get_branch()
     author    = _query_param('author')
@@ -106,58 +189,180 @@ def delete(store, path=ROOT_PATH):
         if not s.get(path):
             # Only raise 404 if key isn't on branch or master
             abort(404, "Not found: %s" % path)
+    if group_committer:
+        return group_committer.delete(s, path, branch=branch, author=author, committer=committer)
     return s.delete(path, branch=branch, author=author, committer=committer)
 
 @app.get('/<store>/keys')
 @app.get('/<store>/keys/<path:path>')
 def keys(store, path=ROOT_PATH):
     pattern     = _get_match_pattern()
+    glob        = _query_param('glob')
     min_level   = _get_min_level()
     max_level   = _get_max_level()
     depth_first = _get_depth_first()
     filter_by   = _query_param('filter_by')
     branch      = _get_branch()
-    commit_sha  = _get_commit_sha()
-    def _keys(store, path, pattern, min_level, max_level, depth_first, filter_by, branch, commit_sha):
-        return {'keys': _get_store(store).keys(path, _get_pattern_re(pattern), min_level, max_level, depth_first, filter_by, branch, commit_sha)}
-    return cache.get('keys', commit_sha, _keys, store, path, pattern, min_level, max_level, depth_first, filter_by, branch, commit_sha)
+    commit_sha  = _get_commit_sha(store, branch)
+    limit       = _get_limit()
+    after       = _get_after(depth_first)
+    if _get_format() == 'ndjson':
+        return _ndjson(_scan(_get_store(store).iterkeys(path, _get_pattern(pattern, glob), min_level, max_level, depth_first, filter_by, branch, commit_sha, limit, after)))
+    def _keys(store, path, pattern, glob, min_level, max_level, depth_first, filter_by, branch, commit_sha, limit, after):
+        keys = list(_scan(_get_store(store).iterkeys(path, _get_pattern(pattern, glob), min_level, max_level, depth_first, filter_by, branch, commit_sha, limit, after)))
+        result = {'keys': keys}
+        if limit:
+            result['next'] = _next_cursor(keys, limit, commit_sha, after)
+        return result
+    return cache.get('keys', commit_sha, _keys, store, path, pattern, glob, min_level, max_level, depth_first, filter_by, branch, commit_sha, limit, after)
 
 @app.get('/<store>/entries')
 @app.get('/<store>/entries/<path:path>')
 def entries(store, path=ROOT_PATH):
     pattern     = _get_match_pattern()
+    glob        = _query_param('glob')
     min_level   = _get_min_level()
     max_level   = _get_max_level()
     depth_first = _get_depth_first()
     branch      = _get_branch()
-    commit_sha  = _get_commit_sha()
-    def _entries(store, path, pattern, min_level, max_level, depth_first, branch, commit_sha):
-        return {'entries': tuple(_get_store(store).entries(path, _get_pattern_re(pattern), min_level, max_level, depth_first, branch, commit_sha))}
-    return cache.get('entries', commit_sha, _entries, store, path, pattern, min_level, max_level, depth_first, branch, commit_sha)
+    commit_sha  = _get_commit_sha(store, branch)
+    limit       = _get_limit()
+    after       = _get_after(depth_first)
+    if _get_format() == 'ndjson':
+        return _ndjson(_scan(_get_store(store).entries(path, _get_pattern(pattern, glob), min_level, max_level, depth_first, branch, commit_sha, limit, after)))
+    def _entries(store, path, pattern, glob, min_level, max_level, depth_first, branch, commit_sha, limit, after):
+        entries = tuple(_scan(_get_store(store).entries(path, _get_pattern(pattern, glob), min_level, max_level, depth_first, branch, commit_sha, limit, after)))
+        result = {'entries': entries}
+        if limit:
+            result['next'] = _next_cursor([key for key, value in entries], limit, commit_sha, after)
+        return result
+    return cache.get('entries', commit_sha, _entries, store, path, pattern, glob, min_level, max_level, depth_first, branch, commit_sha, limit, after)
 
 @app.get('/<store>/diff/<sha:path>')
 def diff(store, sha=None):
-    return {'diff':  _get_store(store).diff(sha) }
+    branch  = _get_branch()
+    new_sha = _query_param('new_sha') or _get_commit_sha(store, branch)
+    if _get_format() == 'ndjson':
+        return _ndjson(_get_store(store).iterdiff(sha, new_sha))
+    def _diff(store, sha, new_sha):
+        return {'diff': _get_store(store).diff(sha, new_sha)}
+    return cache.get('diff', new_sha, _diff, store, sha, new_sha)
+
+@app.get('/<store>/changes', owner=True, long_poll=True)
+def changes(store):
+    """
+    Long-polls for changes to a branch.  Blocks until the head of the branch moves
+    past the since sha, or timeout seconds pass, and returns the new head with the
+    diff from since.  If since is not given it waits for the next commit.  Servers
+    that handle one request at a time don't wait, so a poll can't block the writes
+    it is waiting for.
+    """
+    branch  = _get_branch()
+    since   = _query_param('since') or _get_commit_sha(store, branch)
+    timeout = _get_timeout() if worker_pool is not None else 0
+    try:
+        sha = _get_store(store).wait_for_change(since, branch, timeout)
+    except KeyError:
+        abort(404, "Not found: %s" % branch)
+    response.set_header('X-Commit-Sha', sha)
+    if _get_format() == 'ndjson':
+        if sha == since:
+            return _ndjson(())
+        return _ndjson(_get_store(store).iterdiff(since, sha))
+    if sha == since:
+        return {'sha': sha, 'diff': {}}
+    def _diff(store, sha, new_sha):
+        return {'diff': _get_store(store).diff(sha, new_sha)}
+    result = dict(cache.get('diff', sha, _diff, store, since, sha))
+    result['sha'] = sha
+    return result
 
 
 @app.get('/<store>/trees')
 @app.get('/<store>/trees/<path:path>')
 def trees(store, path=ROOT_PATH):
     pattern      = _get_match_pattern()
+    glob         = _query_param('glob')
     min_level    = _get_min_level()
     max_level    = _get_max_level()
     depth_first  = _get_depth_first()
     object_depth = _get_object_depth()
     branch       = _get_branch()
-    commit_sha   = _get_commit_sha()
-    def _trees(store, path, pattern, min_level, max_level, depth_first, object_depth, branch, commit_sha):
-        return _get_store(store).trees(path, _get_pattern_re(pattern), min_level, max_level, depth_first, object_depth, branch, commit_sha)
-    return cache.get('trees', commit_sha, _trees, store, path, pattern, min_level, max_level, depth_first, object_depth, branch, commit_sha)
+    commit_sha   = _get_commit_sha(store, branch)
+    if _get_format() == 'ndjson':
+        # trees are streamed as entries, which the client can expand with store.expand_tree
+        return _ndjson(_get_store(store).entries(path, _get_pattern(pattern, glob), min_level, max_level, depth_first, branch, commit_sha))
+    def _trees(store, path, pattern, glob, min_level, max_level, depth_first, object_depth, branch, commit_sha):
+        return _get_store(store).trees(path, _get_pattern(pattern, glob), min_level, max_level, depth_first, object_depth, branch, commit_sha)
+    return cache.get('trees', commit_sha, _trees, store, path, pattern, glob, min_level, max_level, depth_first, object_depth, branch, commit_sha)
+
+def _ndjson(items):
+    """
+    Streams items as newline delimited JSON.  Nothing is buffered, so servers which
+    support it send the response with chunked transfer encoding.
+    """
+    response.content_type = 'application/x-ndjson'
+    def _lines():
+        for item in items:
+            yield json.dumps(item) + '\n'
+    return _lines()
+
+def _scan(items):
+    """
+    Starts a paged keys or entries scan before anything is sent, so that a cursor key
+    which isn't in the commit is rejected with a 400 rather than failing mid-stream.
+    """
+    items = iter(items)
+    try:
+        first = next(items, None)
+    except ValueError, e:
+        abort(400, str(e))
+    if first is None:
+        return iter(())
+    return itertools.chain([first], items)
+
+def _next_cursor(keys, limit, commit_sha, after):
+    """
+    Returns the cursor for the page after keys, or None if keys was the last page.
+    """
+    if len(keys) < limit:
+        return None
+    if after:
+        (commit_sha, key) = decode_cursor(after)
+    return encode_cursor(commit_sha, keys[-1])
+
+def _get_limit():
+    limit = _query_param('limit')
+    if limit:
+        limit = int(limit)
+    return limit
+
+def _get_after(depth_first):
+    after = _query_param('after')
+    if after:
+        if not depth_first:
+            abort(400, "Cursors are only supported for depth first scans")
+        try:
+            decode_cursor(after)
+        except ValueError:
+            abort(400, "Invalid cursor: %s" % after)
+    return after
+
+def _get_timeout():
+    timeout = _query_param('timeout')
+    if timeout:
+        return float(timeout)
+    return 30.0
+
+def _get_format():
+    return _query_param('format', 'json')
 
 def _get_match_pattern():
     return _query_param('pattern')
 
-def _get_pattern_re(pattern):
+def _get_pattern(pattern, glob):
+    if glob:
+        return Glob(glob)
     if not pattern:
         return None
     else:
@@ -190,8 +395,18 @@ def _get_object_depth():
 def _get_branch():
     return _query_param('branch', 'master')
 
-def _get_commit_sha():
-    return _query_param('commit_sha')
+def _get_commit_sha(store, branch):
+    """
+    Returns the commit_sha query param, or the sha at the head of branch, so that
+    queries against a branch are cached until the branch moves.
+    """
+    commit_sha = _query_param('commit_sha')
+    if commit_sha:
+        return commit_sha
+    try:
+        return _get_store(store).branch_head(branch)
+    except KeyError:
+        abort(404, "Not found: %s" % branch)
 
 def _get_flatten_keys():
     flatten_keys = _query_param('flatten_keys')
@@ -211,33 +426,257 @@ def _query_param(param, default=None):
     return default
 
 def _get_store(id):
+    """
+    Leases store id from the registry for the rest of the current request.
+    """
     path = _get_repo_path(id)
-    if not path in stores:
-        try:
-            stores[path] = Store(id, path)
-        except ValueError:
-            abort(abort(404, "Not found: %s" % path))
-    return stores[path]
+    try:
+        store = stores.acquire(path, lambda: _open_store(id))
+    except ValueError:
+        abort(404, "Not found: %s" % path)
+    request.environ['herodb.leases'].append(store)
+    return store
+
+def _open_store(id):
+    """
+    Opens store id outside of the registry, for background tasks that shouldn't
+    count as use of the store or evict stores serving requests.
+    """
+    return Store(id, _get_repo_path(id), cache_heads=_owns(id))
+
+def _owner(id):
+    """
+    Returns the id of the worker process that writes to store id.
+    """
+    return zlib.crc32(id) % app.config['workers']
+
+def _owns(id):
+    return _owner(id) == app.config['worker_id']
+
+def _owned_stores():
+    return [s for s in get_stores()['stores'] if _owns(s)]
 
 def _get_repo_path(id):
     return "%s/%s.git" % (app.config.gitstores_path, id)
 
-def run_gc():
+def run_repack():
     while True:
+        time.sleep(app.config['repack_interval'])
         try:
-            stores = get_stores()
-            for s in stores['stores']:
-                store = _get_store(s)
-                store.gc()
-            log.info("done running gc on all repos")
+            for s in _owned_stores():
+                if loose_object_count(_get_repo_path(s)) < app.config['repack_threshold']:
+                    continue
+                store = _open_store(s)
+                try:
+                    store.repack(app.config['repack_threshold'])
+                finally:
+                    store.close()
         except:
-            log.exception("Failure during repo git gc")
-        finally:
-            time.sleep(app.config['gc_interval'])
+            log.exception("Failure during repo repack")
 
-def make_app(stores_path='/tmp', cache_enabled=True, cache_type='memory', cache_size=10000, cache_host='localhost', cache_port=6379, cache_ttl=86400, gc_interval=86400):
+def run_close_idle():
+    while True:
+        time.sleep(app.config['store_idle_timeout'])
+        try:
+            stores.close_idle(app.config['store_idle_timeout'])
+        except:
+            log.exception("Failure closing idle stores")
+
+class LeasePlugin(object):
+    """
+    Releases the stores a request leased with _get_store once its response has been
+    sent, after the last chunk of a streamed response, so the registry never closes
+    a store while a request is still reading from it.
+    """
+    name = 'lease'
+    api = 2
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            leases = request.environ['herodb.leases'] = []
+            try:
+                body = callback(*args, **kwargs)
+            except:
+                _release(leases)
+                raise
+            if isinstance(body, types.GeneratorType):
+                return _release_after(body, leases)
+            _release(leases)
+            return body
+        return wrapper
+
+def _release_after(body, leases):
+    try:
+        for chunk in body:
+            yield chunk
+    finally:
+        _release(leases)
+
+def _release(leases):
+    while leases:
+        stores.release(leases.pop())
+
+class PoolPlugin(object):
+    """
+    Runs route callbacks on a WorkerPool, so that blocking git I/O never runs on the
+    server's front end.  Streamed responses are read from the store on the pool too,
+    a chunk at a time.  Requests are rejected with a 503 when the pool's queue is
+    full and a 504 when they time out.  Routes marked long_poll=True run on their own
+    long_poll_pool instead, so waiting clients never hold the workers other requests
+    need.
+    """
+    name = 'pool'
+    api = 2
+
+    def __init__(self, pool, long_poll_pool=None):
+        self.pool = pool
+        self.long_poll_pool = long_poll_pool
+
+    def apply(self, callback, route):
+        pool = self.pool
+        if route.config.get('long_poll') and self.long_poll_pool is not None:
+            pool = self.long_poll_pool
+        def wrapper(*args, **kwargs):
+            environ = request.environ
+            def call():
+                request.bind(environ)
+                response.bind()
+                body = callback(*args, **kwargs)
+                chunk = None
+                if isinstance(body, types.GeneratorType):
+                    chunk = next_chunk(body)
+                return body, chunk, response.copy()
+            try:
+                (body, chunk, copy) = pool.apply(call)
+            except PoolFull:
+                abort(503, "Too many requests")
+            except PoolTimeout:
+                abort(504, "Request timed out")
+            # on gevent other requests can rebind the request and response while this
+            # one waits for the pool
+            request.bind(environ)
+            response.bind()
+            response.status = copy.status_line
+            for (name, value) in copy.headerlist:
+                response.add_header(name, value)
+            if chunk is not None:
+                return iter_in_pool(pool, body, chunk)
+            return body
+        return wrapper
+
+class OwnerPlugin(object):
+    """
+    When the server runs as several worker processes, forwards requests to routes
+    marked owner=True to the worker that owns the store, so all writes to a store
+    are made by one process and its store lock and change notifications stay valid.
+    Workers reach each other on localhost at internal_port + worker id.
+    """
+    name = 'owner'
+    api = 2
+
+    def apply(self, callback, route):
+        if not route.config.get('owner'):
+            return callback
+        def wrapper(*args, **kwargs):
+            owner = _owner(kwargs['store'])
+            if owner == app.config['worker_id']:
+                return callback(*args, **kwargs)
+            return _forward(owner)
+        return wrapper
+
+def _forward(worker_id):
+    url = request.environ.get('PATH_INFO', '/')
+    if request.query_string:
+        url += '?' + request.query_string
+    headers = {}
+    if request.content_type:
+        headers['Content-Type'] = request.content_type
+    conn = httplib.HTTPConnection('localhost', app.config['internal_port'] + worker_id)
+    try:
+        conn.request(request.method, url, request.body.read(), headers)
+        r = conn.getresponse()
+        response.status = r.status
+        for (name, value) in r.getheaders():
+            if name.lower() not in ('content-length', 'transfer-encoding', 'connection', 'date', 'server'):
+                response.set_header(name, value)
+        return r.read()
+    except socket.error, e:
+        abort(503, "Worker %d unavailable: %s" % (worker_id, e))
+    finally:
+        conn.close()
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+class ThreadedServer(ServerAdapter):
+    """
+    wsgiref server that handles each request on its own thread.
+    """
+
+    def run(self, handler):
+        handler_class = QuietWSGIRequestHandler if self.quiet else WSGIRequestHandler
+        make_server(self.host, self.port, handler, ThreadingWSGIServer, handler_class).serve_forever()
+
+def serve_socket(sock, quiet=False):
+    """
+    Serves the app with a thread per request on a socket that is already listening,
+    such as one inherited from a parent process.
+    """
+    handler_class = QuietWSGIRequestHandler if quiet else WSGIRequestHandler
+    server = ThreadingWSGIServer(sock.getsockname(), handler_class, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    (host, port) = sock.getsockname()[:2]
+    server.server_name = socket.getfqdn(host)
+    server.server_port = port
+    server.setup_environ()
+    server.set_app(app)
+    server.serve_forever()
+
+class GeventServer(ServerAdapter):
+    """
+    gevent WSGI server.  Unlike bottle's gevent adapter it doesn't need the process
+    to be monkey patched; the store runs on real threads in a GeventWorkerPool.
+    """
+
+    def run(self, handler):
+        from gevent import pywsgi
+        log = None if self.quiet else 'default'
+        pywsgi.WSGIServer((self.host, self.port), handler, log=log).serve_forever()
+
+server_adapters = {
+    'wsgiref': 'wsgiref',
+    'threaded': ThreadedServer,
+    'gevent': GeventServer,
+}
+
+def serve(host='localhost', port=8080, server_mode='threaded', quiet=False, reloader=False):
+    run(app, server=server_adapters[server_mode], host=host, port=port, quiet=quiet, reloader=reloader)
+
+def make_app(stores_path='/tmp', cache_enabled=True, cache_type='memory', cache_size=10000, cache_bytes=64*1024*1024, cache_host='localhost', cache_port=6379, cache_ttl=86400, gc_interval=86400,
+             cache_codec='json', cache_compress_threshold=1024,
+             group_commit=False, group_commit_interval=0.05, group_commit_size=1000,
+             object_cache_size=10000, object_cache_bytes=64*1024*1024,
+             value_cache_size=100000, value_cache_bytes=64*1024*1024, value_cache_mode='frozen',
+             repack_interval=60, repack_threshold=1000, max_stores=1000, store_idle_timeout=600,
+             gc_workers=2, gc_stagger=5, gc_busy_window=30,
+             server_mode='threaded', server_workers=10, server_queue_size=100, request_timeout=None, max_long_polls=100,
+             worker_id=0, workers=1, internal_port=None, shared_cache=None):
     global app
     global cache
+    global object_cache
+    global value_cache
+    global group_committer
+    global stores
+    global gc_scheduler
+    global worker_pool
+    global long_poll_pool
+    global mmap_cache
 
     # monkey patch bottle to increase BaseRequest.MEMFILE_MAX
     BaseRequest.MEMFILE_MAX = 1024000
@@ -245,24 +684,94 @@ def make_app(stores_path='/tmp', cache_enabled=True, cache_type='memory', cache_
     setup_logging()
     app.config['gitstores_path'] = stores_path
     app.config['gc_interval'] = gc_interval
+    app.config['repack_interval'] = repack_interval
+    app.config['repack_threshold'] = repack_threshold
+    app.config['store_idle_timeout'] = store_idle_timeout
+    app.config['worker_id'] = worker_id
+    app.config['workers'] = workers
+    app.config['internal_port'] = internal_port
+    stores = StoreRegistry(max_stores)
     cache_backend = None
     if cache_type == 'memory':
-        cache_backend = LocalCache(cache_size)
-    elif cache_type == 'redis':
+        cache_backend = LocalCache(cache_size, cache_bytes)
+    elif cache_type in ('redis', 'tiered'):
         try:
             import redis
-            cache_backend = RedisCache(redis.Redis(cache_host, cache_port), cache_ttl)
+            cache_backend = RedisCache(redis.Redis(cache_host, cache_port), cache_ttl, codecs[cache_codec](), cache_compress_threshold)
         except ImportError:
             pass
+        if cache_type == 'tiered':
+            local = LocalCache(cache_size, cache_bytes)
+            cache_backend = TieredCache(local, cache_backend) if cache_backend else local
     cache = QueryCache(backend=cache_backend, enabled=cache_enabled)
+    object_cache = ObjectCache(object_cache_size, object_cache_bytes)
+    set_object_cache(object_cache)
+    value_cache = ValueCache(value_cache_size, value_cache_bytes, value_cache_mode)
+    set_value_cache(value_cache)
+    mmap_cache = shared_cache
+    set_mmap_cache(mmap_cache)
+    app.uninstall('lease')
+    app.uninstall('owner')
+    app.uninstall('pool')
+    app.install(LeasePlugin())
+    if workers > 1:
+        app.install(OwnerPlugin())
+    worker_pool = None
+    long_poll_pool = None
+    if server_mode == 'gevent':
+        worker_pool = GeventWorkerPool(server_workers, server_queue_size, request_timeout)
+        long_poll_pool = GeventWorkerPool(max_long_polls, 0)
+    elif server_mode == 'threaded':
+        worker_pool = WorkerPool(server_workers, server_queue_size, request_timeout)
+        long_poll_pool = WorkerPool(max_long_polls, 0)
+    if worker_pool is not None:
+        app.install(PoolPlugin(worker_pool, long_poll_pool))
+    group_committer = None
+    if group_commit:
+        group_committer = GroupCommitter(group_commit_interval, group_commit_size)
     if gc_interval > 0:
-        t = threading.Thread(target=run_gc)
+        gc_scheduler = GcScheduler(_owned_stores, _open_store, _get_repo_path, gc_workers, gc_interval, gc_stagger, gc_busy_window)
+        gc_scheduler.start()
+    if repack_interval > 0:
+        t = threading.Thread(target=run_repack)
+        t.setDaemon(True)
+        t.start()
+    if store_idle_timeout > 0:
+        t = threading.Thread(target=run_close_idle)
         t.setDaemon(True)
         t.start()
     return app
 
+def main():
+    parser = argparse.ArgumentParser(prog="herodb")
+    parser.add_argument("stores_path", help="directory containing the store repos")
+    parser.add_argument("--host", default="localhost", help="host to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--server", choices=sorted(server_adapters), default="threaded", help="""
+        server to run: a thread per request (the default), gevent, or the single threaded wsgiref server
+        """.strip())
+    parser.add_argument("--workers", type=int, default=10, help="threads running store calls")
+    parser.add_argument("--queue-size", type=int, default=100, help="""
+        requests that can wait for a worker before new ones are rejected
+        """.strip())
+    parser.add_argument("--timeout", type=float, help="seconds before a request times out")
+    parser.add_argument("--processes", type=int, default=1, help="""
+        worker processes to pre-fork; more than one runs threaded workers sharing an object cache
+        """.strip())
+    parser.add_argument("--shared-cache-bytes", type=int, default=256*1024*1024, help="""
+        size of the object cache shared by worker processes
+        """.strip())
+    parser.add_argument("--no-reloader", dest="reloader", action="store_false", help="don't restart when source files change")
+    args = parser.parse_args()
+    if args.processes > 1:
+        from prefork import serve_prefork
+        serve_prefork(args.stores_path, args.host, args.port, args.processes, shared_cache_bytes=args.shared_cache_bytes,
+                      server_workers=args.workers, server_queue_size=args.queue_size, request_timeout=args.timeout)
+        return
+    if not args.reloader or os.environ.get('BOTTLE_CHILD'):
+        make_app(args.stores_path, server_mode=args.server, server_workers=args.workers,
+                 server_queue_size=args.queue_size, request_timeout=args.timeout)
+    serve(args.host, args.port, args.server, reloader=args.reloader)
+
 if __name__ == '__main__':
-    _app = None
-    if os.environ.get('BOTTLE_CHILD'):
-        _app = make_app(sys.argv[1])
-    run(_app, host='localhost', port='8080', reloader=True)
+    main()
@@ -1,23 +1,84 @@
 from dulwich.repo import Repo
 from dulwich.objects import Tree, Blob
-from dulwich.object_store import tree_lookup_path
+from dulwich.lru_cache import LRUCache
 from dulwich.index import pathjoin, pathsplit
 from dulwich import diff_tree
 from dulwich.errors import NotTreeError
+from dulwich.pack import SHA1Writer, write_pack_header, write_pack_object
 from util import which
+from cache import ObjectCache, ValueCache
 import os
+import errno
 import stat
 import collections
+import itertools
+import heapq
+import fnmatch
+import re
+import sre_parse
+import sre_constants
+import base64
 import json
 import subprocess
+import tempfile
+import shutil
 import threading
 import logging
+import time
 import sys
 import types
+import functools
 from collections import defaultdict
 
 ROOT_PATH = ''
 log = logging.getLogger('herodb.store')
+shared_object_cache = ObjectCache()
+shared_value_cache = ValueCache()
+mmap_cache = None
+_MISSING = object()
+WRITE_ATTEMPTS = 3
+
+def set_object_cache(cache):
+    """
+    Replaces the object cache shared by Store instances created after this call.
+    """
+    global shared_object_cache
+    shared_object_cache = cache
+
+def set_value_cache(cache):
+    """
+    Replaces the value cache shared by Store instances created after this call.
+    """
+    global shared_value_cache
+    shared_value_cache = cache
+
+def set_mmap_cache(cache):
+    """
+    Sets the SharedObjectCache that Store instances created after this call read
+    objects through, or None to not use one.
+    """
+    global mmap_cache
+    mmap_cache = cache
+
+def loose_object_count(repo_path):
+    """
+    Counts the loose objects of the bare repo at repo_path by listing its object
+    directories, without opening the repo.
+    """
+    objects = os.path.join(repo_path, 'objects')
+    count = 0
+    for name in os.listdir(objects):
+        if len(name) == 2:
+            count += len(os.listdir(os.path.join(objects, name)))
+    return count
+
+def write_activity(repo_path):
+    """
+    Returns the number of commits made to the repo at repo_path by this process and
+    the time of the last one, without opening the repo.
+    """
+    state = _repo_state(repo_path)
+    return {'writes': state.writes, 'last_write': state.last_write}
 
 def create(id, repo_path):
     if os.path.exists(repo_path):
@@ -27,14 +88,58 @@ def create(id, repo_path):
     tree = Tree()
     repo.object_store.add_object(tree)
     repo.do_commit(tree=tree.id, message="Initial version")
+    # a repo that was removed and created again at the same path starts fresh
+    with _repo_states_lock:
+        _repo_states.pop(os.path.realpath(repo_path), None)
     return Store(id, repo_path)
 
+_repo_states = {}
+_repo_states_lock = threading.Lock()
+
+class RepoState(object):
+    """
+    State shared by every Store opened on the same repo path: the write lock, the
+    condition waiters for changes sleep on, and the cached branch heads.  A Store
+    that was closed and opened again, or one still used by in-flight requests after
+    a newer instance was opened, stays consistent with the others.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.heads = {}
+        self.writes = 0
+        self.last_write = 0
+
+def _repo_state(repo_path):
+    path = os.path.realpath(repo_path)
+    with _repo_states_lock:
+        state = _repo_states.get(path)
+        if state is None:
+            state = _repo_states[path] = RepoState()
+        return state
+
+def _retry_head_changes(method):
+    """
+    Runs a write again, on top of the new head, if another writer moved the branch
+    while the write was being built.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                return method(self, *args, **kwargs)
+            except HeadChanged:
+                if attempt == WRITE_ATTEMPTS - 1:
+                    raise
+    return wrapper
+
 class Store(object):
     """
     A simple key/value store using git as the backing store.
     """
 
-    def __init__(self, id, repo_path, serializer=None):
+    def __init__(self, id, repo_path, serializer=None, object_cache=None, value_cache=None, cache_heads=True):
         self.id = id
         if os.path.exists(repo_path):
             self.repo = Repo(repo_path)
@@ -44,7 +149,24 @@ class Store(object):
             self.serializer = json
         else:
             self.serializer = serializer
-        self.lock = threading.RLock()
+        state = _repo_state(repo_path)
+        self.lock = state.lock
+        self.changed = state.changed
+        self.object_cache = object_cache or shared_object_cache
+        self.value_cache = value_cache or shared_value_cache
+        self.mmap_cache = mmap_cache
+        self.cache_heads = cache_heads
+        self._indexes = LRUCache(64)
+        self._index_lock = threading.Lock()
+        self._heads = state.heads
+        self._state = state
+
+    def close(self):
+        """
+        Closes the repo's open pack files.  The store can still be used afterwards,
+        packs are opened again as they are needed.
+        """
+        self.repo.close()
 
     def gc(self):
         with self.lock:
@@ -64,38 +186,109 @@ class Store(object):
                 parent = self.branch_head('master')
             branch_ref = self._branch_ref_name(branch)
             self.repo.refs.add_if_new(branch_ref, parent)
+            self._heads.pop(branch_ref, None)
+            self.changed.notify_all()
             return {'sha': self.branch_head(branch)}
 
-    def merge(self, source_branch, target_branch='master', author=None, committer=None):
+    @_retry_head_changes
+    def merge(self, source_branch, target_branch='master', author=None, committer=None, on_conflict='theirs'):
+        """
+        Three-way merge of source_branch into target_branch.  Trees are merged against
+        the trees of the branches' merge base, so subtrees that only one side changed
+        are reused by sha and only trees along changed paths are rebuilt.
+
+        Keys changed differently on both sides are reported as conflicts, dicts of
+        key and base, ours (target) and theirs (source) shas.  on_conflict decides how
+        they are resolved: 'theirs' keeps the source's version, 'ours' the target's, and
+        'fail' raises MergeConflict without committing.
+        """
+        if on_conflict not in ('theirs', 'ours', 'fail'):
+            raise ValueError("Invalid on_conflict: %s" % on_conflict)
         with self.lock:
             if source_branch == target_branch:
                 raise ValueError("Cannot merge branch with itself %s" % source_branch)
-            target_tree = self._get_object(ROOT_PATH, target_branch)
-            branch_tree = self._get_object(ROOT_PATH, source_branch)
-            for tc in diff_tree.tree_changes(self.repo.object_store, target_tree.id, branch_tree.id):
-                if tc.type == diff_tree.CHANGE_ADD:
-                    self._add_tree(target_tree, ((tc.new.path, tc.new.sha, tc.new.mode),))
-                if tc.type == diff_tree.CHANGE_COPY:
-                    pass
-                if tc.type == diff_tree.CHANGE_DELETE:
-                    target_tree = self._delete(tc.old.path, target_branch)
-                if tc.type == diff_tree.CHANGE_MODIFY:
-                    self._add_tree(target_tree, ((tc.new.path, tc.new.sha, tc.new.mode),))
-                if tc.type == diff_tree.CHANGE_RENAME:
-                    pass
-                if tc.type == diff_tree.CHANGE_UNCHANGED:
-                    pass
+            target_sha = self.branch_head(target_branch)
+            source_sha = self.branch_head(source_branch)
+            base_sha = self._merge_base(target_sha, source_sha)
+            base_tree = None
+            if base_sha:
+                base_tree = self._repo_tree(base_sha)
+            conflicts = []
+            tree_id = self._merge_trees(ROOT_PATH, base_tree, self._repo_tree(target_sha), self._repo_tree(source_sha), conflicts, on_conflict)
+            if conflicts and on_conflict == 'fail':
+                raise MergeConflict(conflicts)
             msg = "Merge %s to %s" % (source_branch, target_branch)
-            merge_heads = [self.branch_head(source_branch)]
-            sha = self.repo.do_commit(
-                tree=target_tree.id,
-                message=msg,
-                ref=self._branch_ref_name(target_branch),
-                merge_heads=merge_heads,
-                author=author,
-                committer=committer
-            )
-            return {'sha': sha}
+            sha = self._commit(tree_id, msg, target_branch, target_sha, [source_sha], author, committer)
+            return {'sha': sha, 'conflicts': conflicts}
+
+    def _merge_base(self, sha1, sha2):
+        """
+        Returns the most recent common ancestor of two commits, or None if they have no
+        history in common.  Commits are visited newest first, marking each with the
+        side(s) it was reached from, so only history newer than the base is read.
+        """
+        if sha1 == sha2:
+            return sha1
+        flags = {sha1: 1, sha2: 2}
+        heap = []
+        for sha in (sha1, sha2):
+            heapq.heappush(heap, (-self._read_object(sha).commit_time, sha))
+        while heap:
+            (t, sha) = heapq.heappop(heap)
+            flag = flags[sha]
+            if flag == 3:
+                return sha
+            for parent in self._read_object(sha).parents:
+                parent_flag = flags.get(parent, 0)
+                if parent_flag | flag != parent_flag:
+                    flags[parent] = parent_flag | flag
+                    heapq.heappush(heap, (-self._read_object(parent).commit_time, parent))
+        return None
+
+    def _merge_trees(self, path, base, ours, theirs, conflicts, on_conflict):
+        """
+        Merges the trees with shas ours and theirs against base, any of which may be
+        None, and returns the sha of the merged tree.  Only trees that both sides
+        changed are read and rebuilt; anything else is taken as is from one side.
+        """
+        if ours == theirs or base == theirs:
+            return ours
+        if base == ours:
+            return theirs
+        base_entries = self._tree_entries(base)
+        our_entries = self._tree_entries(ours)
+        their_entries = self._tree_entries(theirs)
+        tree = Tree()
+        for name in set(base_entries).union(our_entries, their_entries):
+            b = base_entries.get(name)
+            o = our_entries.get(name)
+            t = their_entries.get(name)
+            if o == t or b == t:
+                merged = o
+            elif b == o:
+                merged = t
+            elif o and t and stat.S_ISDIR(o[0]) and stat.S_ISDIR(t[0]):
+                base_sha = None
+                if b and stat.S_ISDIR(b[0]):
+                    base_sha = b[1]
+                merged = (stat.S_IFDIR, self._merge_trees(pathjoin(path, name), base_sha, o[1], t[1], conflicts, on_conflict))
+            else:
+                conflicts.append({
+                    'key': pathjoin(path, name),
+                    'base': b and b[1],
+                    'ours': o and o[1],
+                    'theirs': t and t[1],
+                })
+                merged = t if on_conflict == 'theirs' else o
+            if merged:
+                tree.add(name, merged[0], merged[1])
+        self._add_object(tree)
+        return tree.id
+
+    def _tree_entries(self, tree_sha):
+        if not tree_sha:
+            return {}
+        return dict((e.path, (e.mode, e.sha)) for e in self._read_object(tree_sha).iteritems())
 
     def get(self, key, shallow=False, branch='master', commit_sha=None):
         """
@@ -113,7 +306,7 @@ class Store(object):
         obj = self._get_object(key, branch, commit_sha)
         if obj:
             if isinstance(obj, Blob):
-                return self.serializer.loads(obj.data)
+                return self._load_value(obj.id)
             elif isinstance(obj, Tree):
                 keys = key.split('/')
                 min_level = len(filter(None, keys))
@@ -129,47 +322,57 @@ class Store(object):
                 return tree
         return None
 
-    def _get_object(self, key, branch='master', commit_sha=None, bypass_head_cache=True):
+    def _get_object(self, key, branch='master', commit_sha=None, mutable=False):
         try:
             if not commit_sha:
                 commit_sha = self.branch_head(branch)
-            (mode, sha) = tree_lookup_path(self.repo.get_object, self._repo_tree(commit_sha), key)
-            return self.repo[sha]
+            (mode, sha) = self._path_index(commit_sha).lookup(key)
+            obj = self._read_object(sha)
+            if mutable and isinstance(obj, Tree):
+                return _copy_tree(obj)
+            return obj
         except KeyError:
             return None
         except NotTreeError:
             return None
 
-    def diff(self, old_sha, new_sha=None):
+    def diff(self, old_sha, new_sha=None, branch='master'):
         """Show the changed files between OLD_SHA and NEW_SHA
         
-        If NEW_SHA is not set, it will default to HEAD. The output is a 
-        list of tuples (action, filename)
+        If NEW_SHA is not set, it will default to the head of BRANCH. The output
+        is a dict of action -> list of [(key, value)] lists
 
         :param old_sha: parent commit's sha
-        :param new_sha: another sha, defaults to HEAD
+        :param new_sha: another sha, defaults to the head of branch
+        :param branch: branch whose head new_sha defaults to
         :retval: dict
         """
-        orig = self._get_object(ROOT_PATH, commit_sha=old_sha)
-        new = self._get_object(ROOT_PATH)
-        if new_sha:
-            new = self._get_object(ROOT_PATH, commit_sha=new_sha)
-
-        keys = { diff_tree.CHANGE_DELETE: 'delete',
-                 diff_tree.CHANGE_ADD: 'add',
-                 diff_tree.CHANGE_MODIFY: 'modify'}
-
         out = defaultdict(list)
-        for change_tree in diff_tree.tree_changes(self.repo.object_store, orig.id, new.id, want_unchanged=False):
-            if change_tree.type.lower() == "delete" and change_tree.old.path:
-                # if the change was a delete, we have no tree or blob to yield so return key with no value
-                # return in the same type of structure for consistency
-                out[change_tree.type].append([(change_tree.old.path, None)])
-            else:
-                out[change_tree.type].append(filter(None, self.entries(change_tree.new.path)))
+        for action, key, value in self.iterdiff(old_sha, new_sha, branch):
+            out[action].append([(key, value)])
         return out
 
+    def iterdiff(self, old_sha, new_sha=None, branch='master'):
+        """
+        Yields (action, key, value) tuples for every key added, modified or deleted
+        between old_sha and new_sha, where action is 'add', 'modify' or 'delete'.  Values
+        are decoded straight from the changed blobs; deleted keys have a value of None.
+
+        :param old_sha: parent commit's sha
+        :param new_sha: another sha, defaults to the head of branch
+        """
+        if not new_sha:
+            new_sha = self.branch_head(branch)
+        old_tree = self._repo_tree(old_sha)
+        new_tree = self._repo_tree(new_sha)
+        for change_tree in diff_tree.tree_changes(self.repo.object_store, old_tree, new_tree, want_unchanged=False):
+            if change_tree.type == diff_tree.CHANGE_DELETE:
+                if change_tree.old.path:
+                    yield (change_tree.type, change_tree.old.path, None)
+            elif change_tree.type in (diff_tree.CHANGE_ADD, diff_tree.CHANGE_MODIFY):
+                yield (change_tree.type, change_tree.new.path, self._load_value(change_tree.new.sha))
 
+    @_retry_head_changes
     def put(self, key, value, flatten_keys=True, branch='master', author=None, committer=None, overwrite=False):
         """
         Add/Update many key value pairs in the store.  The entries param should be a python
@@ -183,48 +386,246 @@ class Store(object):
             e = {key: value}
             if flatten_keys:
                 e = flatten(e)
-            root_tree = self._get_object(ROOT_PATH, branch)
-            merge_heads = []
-            if not root_tree:
-                root_tree = self._get_object(ROOT_PATH)
-                merge_heads = [self.branch_head('master')]
+            (root_tree, commit_sha, merge_heads) = self._write_base(branch)
             blobs=[]
             msg = ''
-            existing_obj = None
-            if type(value) == types.DictType:
-                try:
-                    existing_obj = self.get(key, shallow=True, branch=branch)
-                except:
-                    pass
-            if existing_obj:
-                if 'commit_sha' in existing_obj:
-                    del existing_obj['commit_sha']
-                existing_obj = flatten({key: existing_obj})
-            for (k, value) in e.iteritems():
-                blob = Blob.from_string(self.serializer.dumps(value))
-                self.repo.object_store.add_object(blob)
+            changed = set(e)
+            if overwrite and type(value) == types.DictType:
+                # stale values directly under key are deleted in the same commit, before
+                # the puts so a deleted path can be rewritten; only the tree at key is
+                # read, and nested subtrees are kept
+                existing = self._get_object(key, commit_sha=commit_sha)
+                if isinstance(existing, Tree):
+                    for entry in existing.iteritems():
+                        k = pathjoin(key, entry.path)
+                        if not stat.S_ISDIR(entry.mode) and k not in e:
+                            blobs.append((k, None, None))
+                            changed.add(k)
+                            msg += "Delete %s\n" % k
+            index = self._path_index(commit_sha)
+            for (k, v) in e.iteritems():
+                blob = Blob.from_string(self.serializer.dumps(v))
                 blobs.append((k, blob.id, stat.S_IFREG))
-                if existing_obj and k in existing_obj:
-                    if existing_obj[k] != value:
-                        msg += "Put %s\n" % k
-                    del existing_obj[k]
-                else:
+                if _index_sha(index, k) != blob.id:
+                    self._add_object(blob)
                     msg += "Put %s\n" % k
-            if overwrite and existing_obj:
-                for k in existing_obj:
-                    self.delete(k, branch=branch)
-                    root_tree = self._get_object(ROOT_PATH, branch)
-
-            root_id = self._add_tree(root_tree, blobs)
-            sha = self.repo.do_commit(
-                tree=root_id, message=msg,
-                ref=self._branch_ref_name(branch),
-                merge_heads=merge_heads,
-                author=author,
-                committer=committer
-            )
-            return {'sha': sha}
+            if not msg and not merge_heads:
+                # every blob sha matches what is already stored
+                return {'sha': commit_sha}
+            return self._write(root_tree, blobs, msg, branch, merge_heads, author, committer, commit_sha, changed)
+
+    @_retry_head_changes
+    def put_many(self, entries, deletes=None, flatten_keys=True, branch='master', author=None, committer=None):
+        """
+        Add/Update and delete many keys in the store with a single commit.  Deletes are
+        applied before puts, so an entry can be written under a key that is deleted in
+        the same call.
+
+        :param entries: A python dict of key value pairs to store.
+        :param deletes: Optional iterable of keys to remove from the store.
+        :return: dict containing the sha of the new commit
+        """
+        with self.lock:
+            if flatten_keys:
+                entries = flatten(entries)
+            deletes = set(deletes or [])
+            (root_tree, commit_sha, merge_heads) = self._write_base(branch)
+            changed = deletes.union(entries)
+            if ROOT_PATH in deletes:
+                # every key changes, so the new commit's index is built from scratch
+                root_tree = Tree()
+                deletes.remove(ROOT_PATH)
+                changed = None
+            blobs = []
+            msg = ''
+            for k in sorted(deletes):
+                blobs.append((k, None, None))
+                msg += "Delete %s\n" % k
+            for (k, value) in entries.iteritems():
+                blob = Blob.from_string(self.serializer.dumps(value))
+                self._add_object(blob)
+                blobs.append((k, blob.id, stat.S_IFREG))
+                msg += "Put %s\n" % k
+            return self._write(root_tree, blobs, msg, branch, merge_heads, author, committer, commit_sha, changed)
 
+    def _write(self, root_tree, blobs, message, branch, merge_heads, author, committer, base_sha, changed):
+        """
+        Applies blobs to root_tree and commits the result to branch.  If the new root
+        tree is the tree of base_sha nothing changed, so base_sha is returned without
+        making a commit, unless the write is creating the branch.
+        """
+        root_id = self._add_tree(root_tree, blobs, commit_sha=base_sha)
+        if not merge_heads and root_id == self._repo_tree(base_sha):
+            return {'sha': base_sha}
+        parent = None if merge_heads else base_sha
+        sha = self._commit(root_id, message, branch, parent, merge_heads, author, committer, base_sha, changed)
+        return {'sha': sha}
+
+    def bulk_import(self, entries, flatten_keys=True, branch='master', author=None, committer=None, message=None):
+        """
+        Import an iterable of (key, value) pairs with a single commit.  Instead of
+        writing a loose object per blob and tree, new objects are spooled to a single
+        packfile, and trees are built bottom-up once every entry has been read.  Entries
+        are applied on top of the branch the same way put_many applies them.
+
+        :param entries: Iterable of (key, value) pairs to store.
+        :return: dict containing the sha of the new commit
+        """
+        root = {}
+        spool = PackSpool()
+        try:
+            # entries are read and their blobs spooled without the lock, which is only
+            # needed once the trees are built on top of the branch
+            count = 0
+            for (key, value) in entries:
+                e = {key: value}
+                if flatten_keys:
+                    e = flatten(e)
+                for (k, v) in e.iteritems():
+                    names = filter(None, k.split('/'))
+                    if not names:
+                        raise ValueError("Can't import a value at the root key")
+                    blob = Blob.from_string(self.serializer.dumps(v))
+                    spool.add(blob)
+                    node = root
+                    for name in names[:-1]:
+                        if type(node.get(name)) != dict:
+                            node[name] = {}
+                        node = node[name]
+                    node[names[-1]] = (stat.S_IFREG, blob.id)
+                    count += 1
+            def build_tree(tree, node):
+                for (name, entry) in node.iteritems():
+                    if type(entry) == dict:
+                        subtree = Tree()
+                        if name in tree:
+                            (mode, sha) = tree[name]
+                            if stat.S_ISDIR(mode):
+                                subtree = _copy_tree(self._read_object(sha))
+                        tree.add(name, stat.S_IFDIR, build_tree(subtree, entry))
+                    else:
+                        tree.add(name, entry[0], entry[1])
+                spool.add(tree)
+                return tree.id
+            with self.lock:
+                (root_tree, commit_sha, merge_heads) = self._write_base(branch)
+                root_id = build_tree(root_tree, root)
+                spool.write(self.repo.object_store)
+                if not merge_heads and root_id == self._repo_tree(commit_sha):
+                    return {'sha': commit_sha}
+                msg = message or "Import %d keys\n" % count
+                sha = self._commit(root_id, msg, branch, None if merge_heads else commit_sha, merge_heads, author, committer)
+                return {'sha': sha}
+        finally:
+            spool.close()
+
+    def repack(self, threshold=0):
+        """
+        Moves loose objects into a new incremental pack, if there are at least threshold
+        of them.  Unlike gc this runs in-process and doesn't hold the store lock while
+        objects are read and the pack is written; the lock is only taken to remove the
+        loose copies once the pack is in place.
+
+        :param threshold: minimum number of loose objects worth packing
+        :return: number of objects packed
+        """
+        object_store = self.repo.object_store
+        shas = list(object_store._iter_loose_objects())
+        if not shas or len(shas) < threshold:
+            return 0
+        spool = PackSpool()
+        try:
+            for sha in shas:
+                obj = object_store._get_loose_object(sha)
+                if obj is not None:
+                    spool.add(obj)
+            spool.write(object_store)
+        finally:
+            spool.close()
+        with self.lock:
+            for sha in spool.shas:
+                try:
+                    object_store._remove_loose_object(sha)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        log.info("packed %d loose objects in repo %s" % (len(spool), self.repo.path))
+        return len(spool)
+
+    def object_counts(self):
+        """
+        Returns the number of loose objects and packs in the repo.
+        """
+        object_store = self.repo.object_store
+        loose = sum(1 for sha in object_store._iter_loose_objects())
+        packs = len([f for f in os.listdir(object_store.pack_dir) if f.endswith('.pack')])
+        return {'loose': loose, 'packs': packs}
+
+    def write_activity(self):
+        """
+        Returns the number of commits made to the repo by this process and the time of
+        the last one.
+        """
+        return {'writes': self._state.writes, 'last_write': self._state.last_write}
+
+    def _add_object(self, obj):
+        """
+        Adds obj to the object store unless it is already there.  dulwich only skips
+        objects that are stored loose, so without this check objects that were packed
+        would be written again as loose objects.
+        """
+        if obj.id not in self.repo.object_store:
+            self.repo.object_store.add_object(obj)
+
+    def _write_base(self, branch):
+        """
+        Returns the (root tree, commit sha, merge heads) a write to branch should start
+        from.  Writes to a branch that doesn't exist yet start from master.
+        """
+        try:
+            commit_sha = self.branch_head(branch)
+            return self._get_object(ROOT_PATH, commit_sha=commit_sha, mutable=True), commit_sha, []
+        except KeyError:
+            commit_sha = self.branch_head('master')
+            return self._get_object(ROOT_PATH, commit_sha=commit_sha, mutable=True), commit_sha, [commit_sha]
+
+    def _commit(self, tree_id, message, branch='master', parent=None, merge_heads=None, author=None, committer=None, base_sha=None, changed=None):
+        """
+        Commit tree_id to branch on top of parent, the head of branch the tree was
+        built from, or None if the commit creates branch.  The ref is only moved if it
+        still points at parent; if another writer moved it, HeadChanged is raised so
+        the write can be made again instead of reverting the other writer's commit.
+        If the commit was built from base_sha by writing or deleting the changed keys,
+        the new commit's path index is derived from the index of base_sha.
+        """
+        ref = self._branch_ref_name(branch)
+        sha = self.repo.do_commit(
+            tree=tree_id,
+            message=message,
+            ref=None,
+            merge_heads=([parent] if parent else []) + (merge_heads or []),
+            author=author,
+            committer=committer
+        )
+        if parent:
+            moved = self.repo.refs.set_if_equals(ref, parent, sha, message="commit: %s" % message)
+        else:
+            moved = self.repo.refs.add_if_new(ref, sha, message="commit: %s" % message)
+        if not moved:
+            self._heads.pop(ref, None)
+            raise HeadChanged(ref)
+        self._heads[ref] = (sha, self._ref_stamp(ref))
+        self._state.writes += 1
+        self._state.last_write = time.time()
+        self.changed.notify_all()
+        if base_sha and changed is not None:
+            with self._index_lock:
+                base = self._indexes.get(base_sha)
+                if base is not None:
+                    self._indexes[sha] = PathIndex(self._read_object, tree_id, base, changed)
+        return sha
+
+    @_retry_head_changes
     def delete(self, key, branch='master', author=None, committer=None):
         """
         Delete one or more entries from the store.  The key param can refer to either
@@ -236,30 +637,28 @@ class Store(object):
         with self.lock:
             tree = self._get_object(key, branch)
             merge_heads = []
-            delete_branch = branch
-            if not tree:
-                merge_heads = [self.branch_head('master')]
-                delete_branch = 'master'
-            root = self._delete(key, delete_branch)
-            sha = self.repo.do_commit(
-                tree=root.id,
-                message="Delete %s" % key,
-                ref=self._branch_ref_name(branch),
-                merge_heads=merge_heads,
-                author=author,
-                committer=committer
-            )
+            if tree:
+                commit_sha = parent = self.branch_head(branch)
+            else:
+                commit_sha = self.branch_head('master')
+                merge_heads = [commit_sha]
+                try:
+                    parent = self.branch_head(branch)
+                except KeyError:
+                    parent = None
+            root = self._delete(key, commit_sha=commit_sha)
+            sha = self._commit(root.id, "Delete %s" % key, branch, parent, merge_heads, author, committer, commit_sha, [key])
             return {'sha': sha}
 
-    def _delete(self, key, branch='master'):
+    def _delete(self, key, branch='master', commit_sha=None):
         trees={}
         path = key
         if path:
             while path:
                 (path, name) = pathsplit(path)
-                trees[path] = self._get_object(path, branch)
+                trees[path] = self._get_object(path, branch, commit_sha, mutable=True)
         else:
-            trees[ROOT_PATH] = self._get_object(ROOT_PATH, branch)
+            trees[ROOT_PATH] = self._get_object(ROOT_PATH, branch, commit_sha, mutable=True)
         (path, name) = pathsplit(key)
         if name:
             del trees[path][name]
@@ -270,17 +669,46 @@ class Store(object):
             while path:
                 (parent_path, name) = pathsplit(path)
                 trees[parent_path].add(name, stat.S_IFDIR, trees[path].id)
-                self.repo.object_store.add_object(trees[path])
+                self._add_object(trees[path])
                 path = parent_path
-            self.repo.object_store.add_object(trees[ROOT_PATH])
+            self._add_object(trees[ROOT_PATH])
         else:
-            self.repo.object_store.add_object(trees[ROOT_PATH])
+            self._add_object(trees[ROOT_PATH])
         return trees[ROOT_PATH]
 
     def _repo_tree(self, commit_sha):
         return self.repo[commit_sha].tree
 
-    def keys(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, filter_by=None, branch='master', commit_sha=None):
+    def _read_object(self, sha):
+        obj = self.object_cache.get(sha)
+        if obj is None:
+            if self.mmap_cache is not None:
+                obj = self.mmap_cache.get(sha)
+            if obj is None:
+                obj = self.repo[sha]
+                if self.mmap_cache is not None:
+                    self.mmap_cache.set(sha, obj)
+            self.object_cache.set(sha, obj)
+        return obj
+
+    def _load_value(self, sha):
+        key = (self.serializer, sha)
+        value = self.value_cache.get(key, _MISSING)
+        if value is _MISSING:
+            data = str(self._read_object(sha).data)
+            value = self.serializer.loads(data)
+            value = self.value_cache.set(key, value, len(data))
+        return value
+
+    def _path_index(self, commit_sha):
+        with self._index_lock:
+            index = self._indexes.get(commit_sha)
+            if index is None:
+                index = PathIndex(self._read_object, self._repo_tree(commit_sha))
+                self._indexes[commit_sha] = index
+            return index
+
+    def keys(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, filter_by=None, branch='master', commit_sha=None, limit=None, after=None):
         """
         Returns a list of keys from the store.  The path param can be used to scope the
         request to return keys from a subset of the tree.  The filter_by param can be used
@@ -292,45 +720,106 @@ class Store(object):
         :param filter_by: Either 'blob', 'tree' or None.  Controls what type of node key
         paths to return.  Default is None which returns all node type key paths
         :param branch: The branch name to return key paths for.
+        :param limit: Optional maximum number of keys to return.
+        :param after: Optional cursor from make_cursor() to resume a previous scan after.
+        The scan continues from the commit the cursor was made for.
         :return: A list of keys sorted lexically.
         """
+        return list(self.iterkeys(path, pattern, min_level, max_level, depth_first, filter_by, branch, commit_sha, limit, after))
+
+    def iterkeys(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, filter_by=None, branch='master', commit_sha=None, limit=None, after=None):
+        """
+        Generator version of keys() which yields keys as the tree is traversed.
+        """
+        after_key = None
+        if after:
+            (commit_sha, after_key) = decode_cursor(after)
         if filter_by == 'blob':
-            filter_fn = lambda tree_entry: isinstance(tree_entry[1], Blob)
+            filter_fn = lambda mode: not stat.S_ISDIR(mode)
         elif filter_by == 'tree':
-            filter_fn = lambda tree_entry: isinstance(tree_entry[1], Tree)
+            filter_fn = lambda mode: stat.S_ISDIR(mode)
         else:
-            filter_fn = None
-        return map(lambda x: x[0], filter(filter_fn, self.iteritems(path, pattern, min_level, max_level, depth_first, branch, commit_sha)))
+            filter_fn = lambda mode: True
+        nodes = self._iternodes(path, pattern, min_level, max_level, depth_first, branch, commit_sha, after_key)
+        keys = (key for key, mode, sha, tree in nodes if filter_fn(mode))
+        for key in itertools.islice(keys, limit):
+            yield key
 
-    def entries(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, branch='master', commit_sha=None):
-        for key, obj in self.iteritems(path, pattern, min_level, max_level, depth_first, branch, commit_sha):
-            if isinstance(obj, Blob):
-                yield (key, self.serializer.loads(str(obj.data)))
+    def entries(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, branch='master', commit_sha=None, limit=None, after=None):
+        """
+        Yields (key, value) tuples for every blob under path.  The limit and after params
+        page through the entries the same way as keys().
+        """
+        after_key = None
+        if after:
+            (commit_sha, after_key) = decode_cursor(after)
+        nodes = self._iternodes(path, pattern, min_level, max_level, depth_first, branch, commit_sha, after_key)
+        blobs = ((key, sha) for key, mode, sha, tree in nodes if not stat.S_ISDIR(mode))
+        for key, sha in itertools.islice(blobs, limit):
+            yield (key, self._load_value(sha))
 
-    def iteritems(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, branch='master', commit_sha=None):
+    def make_cursor(self, key, branch='master', commit_sha=None):
+        """
+        Returns an opaque cursor which resumes a keys() or entries() scan after key, on
+        the commit the scan was made against.
+        """
+        if not commit_sha:
+            commit_sha = self.branch_head(branch)
+        return encode_cursor(commit_sha, key)
+
+    def iteritems(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, branch='master', commit_sha=None, after_key=None):
+        """
+        Yields (key, object) tuples for every Tree and Blob under path.
+        """
+        for key, mode, sha, tree in self._iternodes(path, pattern, min_level, max_level, depth_first, branch, commit_sha, after_key):
+            if tree is not None:
+                yield (key, tree)
+            else:
+                yield (key, self._read_object(sha))
+
+    def _iternodes(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, branch='master', commit_sha=None, after_key=None):
+        """
+        Yields (key, mode, sha, tree) tuples for every node under path.  Blobs are told
+        apart from trees by their tree entry mode and are never read, so tree is None
+        for blobs.
+        """
+        def _node(level, path, mode, sha):
+            tree = None
+            if stat.S_ISDIR(mode):
+                tree = self._read_object(sha)
+            return level, path, mode, sha, tree
+        def _children(level, path, tree):
+            if not min_level < level+1 <= max_level:
+                return []
+            children = []
+            for tree_entry in tree.iteritems():
+                child_path = self._tree_entry_key(path, tree_entry)
+                # skip subtrees that can't contain a key matching pattern
+                if descend(child_path):
+                    children.append(_node(level+1, child_path, tree_entry.mode, tree_entry.sha))
+            return children
+        descend = _descend_fn(pattern)
         try:
-            import gevent
-        except:
-            gevent = None
-        def _node(level, path, node):
-            return level, path, node
-        root = self._get_object(path, branch=branch, commit_sha=commit_sha)
-        bypass_head_cache=False
-        level = len(filter(None, path.split('/')))
+            if not commit_sha:
+                commit_sha = self.branch_head(branch)
+            (mode, sha) = self._path_index(commit_sha).lookup(path)
+        except (KeyError, NotTreeError):
+            return
+        root = _node(len(filter(None, path.split('/'))), path, mode, sha)
         if min_level is None:
             min_level = 0
         if max_level is None:
             max_level = sys.maxint
-        nodes_to_visit = collections.deque([_node(level, path, root)])
+        if after_key is None:
+            nodes_to_visit = collections.deque([root])
+        else:
+            if not depth_first:
+                raise ValueError("Cursors are only supported for depth first scans")
+            nodes_to_visit = self._resume_nodes(root, after_key, _children)
         while len(nodes_to_visit) > 0:
-            # allow server to yield to other greenlets during long tree traversals
-            if gevent:
-                gevent.sleep(0)
-            (level, path, node) = nodes_to_visit.popleft()
-            if isinstance(node, Tree):
-                children = filter(lambda child: min_level < child[0] <= max_level, 
-                                  map(lambda child: _node(level+1, *self._tree_entry(path, child, bypass_head_cache)), 
-                                      node.iteritems()))
+            (level, path, mode, sha, tree) = nodes_to_visit.popleft()
+            if tree is not None:
+                children = _children(level, path, tree)
                 if depth_first:
                     nodes_to_visit.extendleft(children)
                 else:
@@ -338,9 +827,36 @@ class Store(object):
             if min_level < level <= max_level:
                 if pattern is not None:
                     if pattern.match(path):
-                        yield (path, node)
+                        yield (path, mode, sha, tree)
                 else:
-                    yield (path, node)
+                    yield (path, mode, sha, tree)
+
+    def _resume_nodes(self, node, after_key, children_fn):
+        """
+        Rebuilds the depth first traversal queue as it was right after after_key was
+        visited.  Only the trees on the path to after_key are read; subtrees that were
+        already visited are skipped by their position in the tree entry order.
+        """
+        nodes_to_visit = collections.deque()
+        (level, path, mode, sha, tree) = node
+        if path and not (after_key == path or after_key.startswith(path + '/')):
+            raise ValueError("Cursor key %s is not under %s" % (after_key, path))
+        for name in filter(None, after_key[len(path):].split('/')):
+            if tree is None:
+                raise ValueError("Invalid cursor key %s" % after_key)
+            children = children_fn(level, path, tree)
+            child_path = pathjoin(path, name)
+            for i, child in enumerate(children):
+                if child[1] == child_path:
+                    break
+            else:
+                raise ValueError("Invalid cursor key %s" % after_key)
+            # children are visited in reverse, so the ones before child are still to come
+            nodes_to_visit.extendleft(children[:i])
+            (level, path, mode, sha, tree) = child
+        if tree is not None:
+            nodes_to_visit.extendleft(children_fn(level, path, tree))
+        return nodes_to_visit
 
     def trees(self, path=ROOT_PATH, pattern=None, min_level=None, max_level=None, depth_first=True, object_depth=None, branch='master', commit_sha=None):
         """
@@ -363,22 +879,38 @@ class Store(object):
             expand_tree(key, value, tree, object_depth)
         return tree
 
-    def _head_cache_key(self, key):
-        return "%s/%s" % (self.id, key)
-
-    def _tree_entry(self, path, tree_entry, branch='master', bypass_head_cache=False):
-        child_path = self._tree_entry_key(path, tree_entry)
-        obj = None
-        if obj is None:
-            obj = self.repo[tree_entry.sha]
-        return child_path, obj
-
     def _tree_entry_key(self, path, tree_entry):
         if path:
             return "%s/%s" % (path, tree_entry.path)
         else:
             return tree_entry.path
 
+    def wait_for_change(self, since, branch='master', timeout=None):
+        """
+        Blocks until the head of branch is no longer since, or timeout seconds have
+        passed, and returns the head of branch.  Every commit made through this store
+        wakes up waiting threads, so callers don't have to poll the branch ref.
+
+        :param since: the commit sha the caller has already seen
+        :param timeout: seconds to wait, or None to wait forever
+        :retval: the sha at the head of branch, which is since if the wait timed out
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.lock:
+            head = self.branch_head(branch)
+            while head == since:
+                if deadline is None:
+                    self.changed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.changed.wait(remaining)
+                head = self.branch_head(branch)
+            return head
+
     def _branch_ref_name(self, name):
         if name.startswith('refs/heads/'):
             return name
@@ -386,23 +918,57 @@ class Store(object):
             return "refs/heads/%s" % name
 
     def branch_head(self, name):
+        """
+        Returns the sha of the commit at the head of branch name.  Heads are cached in
+        memory with a stat of the file holding the ref, so a lookup only reads the ref
+        again if something else, such as herodb_import, changed it.  Stores opened with
+        cache_heads off always read the ref.
+        """
+        ref = self._branch_ref_name(name)
+        if not self.cache_heads:
+            return self.repo.refs[ref]
+        stamp = self._ref_stamp(ref)
+        cached = self._heads.get(ref)
+        if cached is not None and cached[1] == stamp:
+            return cached[0]
         with self.lock:
-            return self.repo.refs[self._branch_ref_name(name)]
+            sha = self.repo.refs[ref]
+            self._heads[ref] = (sha, stamp)
+        return sha
+
+    def _ref_stamp(self, ref):
+        """
+        Returns the path and stat of the file a ref is read from: its loose ref file,
+        or packed-refs if it has none.  Writers replace the file, so a new stamp means
+        the ref may have changed.
+        """
+        for path in (self.repo.refs.refpath(ref), os.path.join(self.repo.controldir(), 'packed-refs')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            return (path, st.st_ino, st.st_mtime, st.st_size)
+        return None
 
     def _add_tree(self, root_tree, blobs, branch='master', commit_sha=None):
         """Commit a new tree.
 
         :param root_tree: Root tree to add trees to
-        :param blobs: Iterable over blob path, sha, mode entries
+        :param blobs: Iterable over blob path, sha, mode entries.  An entry with a sha
+        of None removes that path from the tree.
         :return: SHA1 of the created tree.
         """
         trees = {"": {}}
+        replaced = set()
         def add_tree(path):
             if path in trees:
                 return trees[path]
             dirname, basename = pathsplit(path)
             t = add_tree(dirname)
             assert isinstance(basename, basestring)
+            if basename in t and t[basename] is None:
+                # the subtree is deleted before new entries are added to it
+                replaced.add(path)
             newtree = {}
             t[basename] = newtree
             trees[path] = newtree
@@ -411,29 +977,249 @@ class Store(object):
         for path, sha, mode in blobs:
             tree_path, basename = pathsplit(path)
             tree = add_tree(tree_path)
-            tree[basename] = (mode, sha)
+            if sha is None:
+                tree[basename] = None
+            else:
+                tree[basename] = (mode, sha)
 
         def build_tree(path):
-            if path:
-                tree = self._get_object(path, branch=branch, commit_sha=commit_sha)
-                if not tree:
-                    tree = Tree()
+            created = False
+            if path in replaced:
+                tree = Tree()
+            elif path:
+                tree = self._get_object(path, branch=branch, commit_sha=commit_sha, mutable=True)
                 if not isinstance(tree, Tree):
-                    self.delete(path, branch=branch)
                     tree = Tree()
+                    created = True
             else:
                 tree = root_tree
             for basename, entry in trees[path].iteritems():
+                if entry is None:
+                    if basename in tree:
+                        del tree[basename]
+                    continue
                 if type(entry) == dict:
                     mode = stat.S_IFDIR
                     sha = build_tree(pathjoin(path, basename))
+                    if sha is None:
+                        continue
                 else:
                     (mode, sha) = entry
                 tree.add(basename, mode, sha)
-            self.repo.object_store.add_object(tree)
+            if created and len(tree) == 0:
+                # don't create empty trees for deletes of keys that don't exist
+                return None
+            self._add_object(tree)
             return tree.id
         return build_tree("")
 
+class PackSpool(object):
+    """
+    Collects git objects in a temporary file and writes them to an object store as a
+    single pack.  A pack's header holds its object count, so objects are spooled
+    until the count is known instead of being held in memory.
+    """
+
+    def __init__(self):
+        self.shas = set()
+        self.f = tempfile.TemporaryFile()
+
+    def __len__(self):
+        return len(self.shas)
+
+    def add(self, obj):
+        if obj.id not in self.shas:
+            write_pack_object(self.f, obj.type_num, obj.as_raw_string())
+            self.shas.add(obj.id)
+
+    def write(self, object_store):
+        """
+        Writes the spooled objects to object_store as a pack with an index, and
+        returns the pack, or None if nothing was spooled.
+        """
+        if not self.shas:
+            return None
+        f, commit, abort = object_store.add_pack()
+        try:
+            writer = SHA1Writer(f)
+            write_pack_header(writer, len(self.shas))
+            self.f.seek(0)
+            shutil.copyfileobj(self.f, writer)
+            writer.write_sha()
+        except:
+            abort()
+            raise
+        return commit()
+
+    def close(self):
+        self.f.close()
+
+class HeadChanged(Exception):
+    """
+    Raised when a commit can't be made because another writer moved the branch after
+    the commit was built.
+    """
+
+    def __init__(self, ref):
+        Exception.__init__(self, "%s changed during commit" % ref)
+        self.ref = ref
+
+class MergeConflict(Exception):
+    """
+    Raised by Store.merge when on_conflict is 'fail' and both branches changed the
+    same keys.  conflicts lists the keys with their base, ours and theirs shas.
+    """
+
+    def __init__(self, conflicts):
+        Exception.__init__(self, "Merge conflict on %s" % ", ".join(c['key'] for c in conflicts))
+        self.conflicts = conflicts
+
+class PathIndex(object):
+    """
+    Lazily built map of key path -> (mode, sha) for the tree of a single commit.  Each
+    lookup resolves from the nearest indexed parent, so a path costs at most one tree
+    read per level the first time and none after that.  An index derived from the
+    index of a parent commit falls through to it for every path the new commit didn't
+    change.
+    """
+
+    max_depth = 16
+    max_entries = 100000
+
+    def __init__(self, read_object, tree_sha, base=None, changed=()):
+        self.read_object = read_object
+        self.entries = {ROOT_PATH: (stat.S_IFDIR, tree_sha)}
+        self.base = None
+        self.depth = 0
+        if base is not None and base.depth < self.max_depth:
+            self.base = base
+            self.depth = base.depth + 1
+        self.changed = set()
+        self.changed_dirs = set()
+        for key in changed:
+            key = _normalize_key(key)
+            self.changed.add(key)
+            while key:
+                self.changed_dirs.add(key)
+                (key, name) = pathsplit(key)
+
+    def lookup(self, key):
+        """
+        Returns the (mode, sha) of key.  Raises KeyError if key doesn't exist and
+        NotTreeError if a parent of key is a blob.
+        """
+        key = _normalize_key(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            if self.base is not None and not self._changed(key):
+                entry = self.base.lookup(key)
+            else:
+                (parent, name) = pathsplit(key)
+                (mode, sha) = self.lookup(parent)
+                if not stat.S_ISDIR(mode):
+                    raise NotTreeError(sha)
+                entry = self.read_object(sha)[name]
+            if len(self.entries) < self.max_entries:
+                self.entries[key] = entry
+        return entry
+
+    def _changed(self, key):
+        if key in self.changed_dirs:
+            return True
+        while key:
+            (key, name) = pathsplit(key)
+            if key in self.changed:
+                return True
+        return False
+
+class Glob(object):
+    """
+    Matches keys against a glob such as 'users/*/profile', where each glob segment
+    matches one key segment.  Like a regex passed as pattern, a glob also matches
+    every key under a matching key.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.segments = filter(None, pattern.split('/'))
+
+    def match(self, path):
+        parts = filter(None, path.split('/'))
+        return len(parts) >= len(self.segments) and self._match_parts(parts)
+
+    def descend(self, path):
+        return self._match_parts(filter(None, path.split('/')))
+
+    def _match_parts(self, parts):
+        for part, segment in zip(parts, self.segments):
+            if not fnmatch.fnmatchcase(part, segment):
+                return False
+        return True
+
+def _descend_fn(pattern):
+    """
+    Returns a function which tells whether a traversal has to visit path to find keys
+    matching pattern.  Regex patterns are pruned by their literal prefix.
+    """
+    if pattern is None:
+        return lambda path: True
+    if hasattr(pattern, 'descend'):
+        return pattern.descend
+    prefix = _literal_prefix(pattern)
+    if not prefix:
+        return lambda path: True
+    return lambda path: path.startswith(prefix) or prefix.startswith(path + '/')
+
+def _literal_prefix(pattern):
+    """
+    Returns the literal text every string matched by the compiled regex pattern starts
+    with, or '' if there isn't any.
+    """
+    if not hasattr(pattern, 'pattern') or pattern.flags & re.IGNORECASE:
+        return ''
+    prefix = []
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return ''
+    for op, av in parsed:
+        if op == sre_constants.AT and av == sre_constants.AT_BEGINNING:
+            continue
+        if op != sre_constants.LITERAL or av > 127:
+            break
+        prefix.append(chr(av))
+    return ''.join(prefix)
+
+def encode_cursor(commit_sha, key):
+    return base64.urlsafe_b64encode(json.dumps([commit_sha, key]))
+
+def decode_cursor(cursor):
+    try:
+        (commit_sha, key) = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+    if not isinstance(commit_sha, basestring) or not isinstance(key, basestring):
+        raise ValueError("Invalid cursor: %s" % cursor)
+    return str(commit_sha), key.encode('utf-8')
+
+def _copy_tree(tree):
+    copy = Tree()
+    for entry in tree.iteritems():
+        copy.add(entry.path, entry.mode, entry.sha)
+    return copy
+
+def _index_sha(index, key):
+    """
+    Returns the sha stored at key in a PathIndex, or None if there is nothing there.
+    """
+    try:
+        return index.lookup(key)[1]
+    except (KeyError, NotTreeError):
+        return None
+
+def _normalize_key(key):
+    return '/'.join(filter(None, key.split('/')))
+
 def flatten(d, parent_key=ROOT_PATH, sep='/'):
     items = []
     for k, v in d.items():
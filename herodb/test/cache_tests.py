@@ -0,0 +1,268 @@
+from herodb.cache import SizedLRUCache, ValueCache, SharedObjectCache, LocalCache, QueryCache, CacheEncoding, TieredCache, RedisCache, JsonCodec
+from dulwich.objects import Blob
+import os
+import threading
+import time
+from nose import tools as nt
+
+def test_sized_lru_entries():
+    cache = SizedLRUCache(max_entries=2)
+    cache.set('a', 'a')
+    cache.set('b', 'b')
+    nt.assert_equal(cache.get('a'), 'a')
+    cache.set('c', 'c')
+    nt.assert_true('a' in cache)
+    nt.assert_true('b' not in cache)
+    nt.assert_equal(cache.get('b'), None)
+    nt.assert_equal(cache.get_stats()['hits'], 1)
+    nt.assert_equal(cache.get_stats()['misses'], 1)
+    nt.assert_equal(cache.get_stats()['evictions'], 1)
+
+def test_sized_lru_bytes():
+    cache = SizedLRUCache(max_entries=100, max_bytes=10)
+    cache.set('a', 'aaaa')
+    cache.set('b', 'bbbb')
+    nt.assert_equal(cache.bytes, 8)
+    cache.set('c', 'cccc')
+    nt.assert_true('a' not in cache)
+    nt.assert_equal(cache.bytes, 8)
+    cache.set('d', 'd' * 11)
+    nt.assert_true('d' not in cache)
+    cache.remove('b')
+    nt.assert_equal(cache.size(), 1)
+    nt.assert_equal(cache.bytes, 4)
+
+def test_value_cache_modes():
+    cache = ValueCache(mode='copy')
+    value = cache.set('k', {'a': [1]})
+    nt.assert_equal(cache.get('k'), None)
+    cache.set('n', 1, 1)
+    nt.assert_equal(cache.get('n'), 1)
+    cache = ValueCache(mode='frozen')
+    value = cache.set('k', {'a': [1]})
+    nt.assert_equal(value, {'a': (1,)})
+    nt.assert_raises(TypeError, value.__setitem__, 'b', 2)
+    nt.assert_true(cache.get('k') is value)
+
+def test_shared_object_cache():
+    cache = SharedObjectCache(max_bytes=64*1024, slot_size=1024)
+    blob = Blob.from_string('value')
+    nt.assert_equal(cache.get(blob.id), None)
+    cache.set(blob.id, blob)
+    nt.assert_equal(cache.get(blob.id).as_raw_string(), 'value')
+    big = Blob.from_string('x' * 2048)
+    cache.set(big.id, big)
+    nt.assert_equal(cache.get(big.id), None)
+    nt.assert_equal(cache.get_stats()['hits'], 1)
+
+    # objects set by a forked child are visible to the parent
+    other = Blob.from_string('from child')
+    pid = os.fork()
+    if pid == 0:
+        cache.set(other.id, other)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    nt.assert_equal(cache.get(other.id).as_raw_string(), 'from child')
+
+def test_local_cache():
+    cache = LocalCache(max_entries=100, max_bytes=100*1024, shards=4)
+    cache.set(('get', 'a'), {'x': 1})
+    nt.assert_true(('get', 'a') in cache)
+    nt.assert_equal(cache.get(('get', 'a')), {'x': 1})
+    cache.remove(('get', 'a'))
+    nt.assert_false(('get', 'a') in cache)
+    nt.assert_equal(cache.size(), 0)
+    cache.set(('get', 'big'), 'x' * 200*1024)
+    nt.assert_equal(cache.get(('get', 'big')), None)
+    for i in range(1000):
+        cache.set(('get', i), i)
+    nt.assert_true(cache.size() <= 100)
+    # the byte limit is shared by the shards, so a result bigger than a shard's share
+    # is still cached
+    cache.set(('trees', 'big'), 'x' * 60*1024)
+    nt.assert_equal(len(cache.get(('trees', 'big'))), 60*1024)
+    for i in range(5):
+        cache.set(('trees', i), 'x' * 30*1024)
+    nt.assert_true(cache.bytes() <= 100*1024)
+    nt.assert_equal(len(cache.get(('trees', 4))), 30*1024)
+
+def test_query_cache_stats():
+    cache = QueryCache()
+    threads = [threading.Thread(target=lambda: [cache.get('get', 'sha', lambda i: i, i % 10) for i in range(1000)]) for j in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cache.get('trees', 'sha', lambda: {'a': 1})
+    cache.get('trees', None, lambda: {'a': 1})
+    stats = cache.get_stats()
+    nt.assert_equal(stats['requests'], 4002)
+    nt.assert_equal(stats['hits'] + stats['misses'], 4001)
+    nt.assert_equal(stats['operations']['get']['requests'], 4000)
+    nt.assert_true(stats['operations']['get']['hit_rate'] > 0.9)
+    nt.assert_equal(stats['operations']['trees']['misses'], 1)
+    # threads record into different stripes
+    nt.assert_true(len([ops for (lock, ops) in cache._stripes if ops]) > 1)
+
+def test_query_cache_coalescing():
+    cache = QueryCache()
+    calls = []
+    def slow_trees(path):
+        calls.append(path)
+        time.sleep(0.2)
+        return {'a': 1}
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('trees', 'sha', slow_trees, 'a'))) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    nt.assert_equal(calls, ['a'])
+    nt.assert_equal(results, [{'a': 1}] * 5)
+    stats = cache.get_stats()
+    nt.assert_equal(stats['coalesced'], 4)
+    nt.assert_equal(stats['operations']['trees']['coalesced'], 4)
+    nt.assert_equal(stats['misses'], 1)
+
+def test_query_cache_coalesced_error():
+    cache = QueryCache()
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('bad query')
+    errors = []
+    def get():
+        try:
+            cache.get('get', 'sha', fail)
+        except ValueError, e:
+            errors.append(e)
+    threads = [threading.Thread(target=get) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    nt.assert_equal(len(errors), 3)
+    nt.assert_equal(cache.get_stats()['coalesced'], 2)
+
+def test_cache_encoding():
+    encoding = CacheEncoding(compress_threshold=100)
+    value = {'a': {'x': 1, 'y': [1, 2]}, 'b': 'text'}
+    data = encoding.encode(value)
+    nt.assert_equal(encoding.decode(data), value)
+    big = {'a': 'x' * 1000}
+    data = encoding.encode(big)
+    nt.assert_true(len(data) < 100)
+    nt.assert_equal(encoding.decode(data), big)
+    nt.assert_equal(encoding.decode(None), None)
+    # entries from another format version read as misses
+    nt.assert_equal(encoding.decode(chr(encoding.version + 1) + data[1:]), None)
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.calls = []
+
+    def dbsize(self):
+        return len(self.data)
+
+    def get(self, key):
+        self.calls.append('get')
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.calls.append('mget')
+        return [self.data.get(k) for k in keys]
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set(self, key, value):
+        self.commands.append(lambda: self.redis.data.__setitem__(key, value))
+
+    def expire(self, key, seconds):
+        self.commands.append(lambda: self.redis.expires.__setitem__(key, seconds))
+
+    def execute(self):
+        self.redis.calls.append('execute')
+        for command in self.commands:
+            command()
+
+def test_redis_cache():
+    connection = FakeRedis()
+    cache = RedisCache(connection, expire=60, compress_threshold=100)
+    key = ('trees', 'store', 'a', None, True)
+    value = {'a': {'x': 1, 'y': [1, 2]}}
+    cache.set(key, value)
+    nt.assert_equal(connection.calls, ['execute'])
+    redis_key = 'herodb:v1:["trees","store","a",null,true]'
+    nt.assert_equal(connection.data.keys(), [redis_key])
+    nt.assert_equal(connection.expires, {redis_key: 60})
+    nt.assert_equal(cache.get(key), value)
+    nt.assert_equal(cache.get(('trees', 'missing')), None)
+    big = {'a': 'x' * 1000}
+    cache.set(('get', 'big'), big)
+    nt.assert_true(len(connection.data['herodb:v1:["get","big"]']) < 100)
+    connection.calls = []
+    nt.assert_equal(cache.get_many([key, ('get', 'missing'), ('get', 'big')]), [value, None, big])
+    nt.assert_equal(connection.calls, ['mget'])
+    nt.assert_equal(cache.get_many([]), [])
+    nt.assert_equal(cache.size(), 2)
+
+def test_redis_cache_codec_mismatch():
+    connection = FakeRedis()
+    RedisCache(connection).set(('get', 'a'), 1)
+    # entries written with another codec read as misses
+    class OtherCodec(JsonCodec):
+        id = 99
+    nt.assert_equal(RedisCache(connection, codec=OtherCodec()).get(('get', 'a')), None)
+    nt.assert_equal(RedisCache(connection).get(('get', 'a')), 1)
+
+def test_tiered_cache():
+    shared = LocalCache(100)
+    cache = TieredCache(LocalCache(100), shared)
+    nt.assert_equal(cache.get(('get', 'a')), None)
+    shared.set(('get', 'a'), {'x': 1})
+    nt.assert_equal(cache.get(('get', 'a')), {'x': 1})
+    nt.assert_equal(cache.local.get(('get', 'a')), {'x': 1})
+    nt.assert_equal(cache.get(('get', 'a')), {'x': 1})
+    cache.set(('get', 'b'), 2)
+    nt.assert_equal(shared.get(('get', 'b')), 2)
+    shared.set(('get', 'c'), 3)
+    nt.assert_equal(cache.get_many([('get', 'b'), ('get', 'c'), ('get', 'd')]), [2, 3, None])
+    nt.assert_equal(cache.get_stats(), {
+        'local': {'hits': 2, 'misses': 4},
+        'shared': {'hits': 2, 'misses': 2},
+    })
+    query_cache = QueryCache(backend=cache)
+    nt.assert_equal(query_cache.get_stats()['tiers'], cache.get_stats())
+
+def test_query_cache_backend_failure():
+    class BrokenBackend(LocalCache):
+        def set(self, key, value):
+            raise IOError('cache down')
+    cache = QueryCache(backend=BrokenBackend())
+    def slow_get():
+        time.sleep(0.2)
+        return 1
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('get', 'sha', slow_get))) for i in range(3)]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join(5)
+    # a failed cache write neither fails the query nor strands coalesced callers
+    nt.assert_equal(results, [1, 1, 1])
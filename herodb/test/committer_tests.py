@@ -0,0 +1,58 @@
+from herodb.store import create
+from herodb.committer import GroupCommitter
+from nose import tools as nt
+import os
+import shutil
+import threading
+
+TEST_REPO = "/tmp/test_committer.git"
+
+store = None
+
+def setUp():
+    if os.path.exists(TEST_REPO):
+        shutil.rmtree(TEST_REPO)
+    global store
+    store = create('test', TEST_REPO)
+
+def tearDown():
+    global store
+    store = None
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_group_commit():
+    committer = GroupCommitter(interval=0.2, max_ops=1000)
+    results = {}
+    def put(i):
+        results[i] = committer.put(store, "k/%d" % i, i)
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    nt.assert_true(committer.get_stats()['commits'] < 20)
+    nt.assert_equal(committer.get_stats()['writes'], 20)
+    for i in range(20):
+        nt.assert_equal(store.get("k/%d" % i, commit_sha=results[i]['sha']), i)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_group_commit_ordering():
+    committer = GroupCommitter(interval=0.2, max_ops=1000)
+    store.put('a', {'x': 1})
+    results = []
+    def write(fn, *args):
+        results.append(fn(store, *args))
+    threads = [
+        threading.Thread(target=write, args=(committer.put, 'a/y', 2)),
+        threading.Thread(target=write, args=(committer.delete, 'a')),
+        threading.Thread(target=write, args=(committer.put, 'a/z', 3)),
+    ]
+    for t in threads:
+        t.start()
+        t.join(0.05)
+    for t in threads:
+        t.join()
+    nt.assert_equal(store.get('a/x'), None)
+    nt.assert_equal(store.get('a/y'), None)
+    nt.assert_equal(store.get('a/z'), 3)
+    nt.assert_equal(len(set(r['sha'] for r in results)), 2)
@@ -0,0 +1,61 @@
+from herodb.pool import WorkerPool, PoolFull, PoolTimeout, iter_in_pool
+from nose import tools as nt
+import threading
+import time
+
+def test_apply():
+    pool = WorkerPool(workers=2)
+    nt.assert_equal(pool.apply(lambda x, y=0: x + y, 1, y=2), 3)
+    nt.assert_raises(ZeroDivisionError, pool.apply, lambda: 1 / 0)
+    nt.assert_equal(pool.get_stats()['calls'], 2)
+
+def test_queue_full():
+    pool = WorkerPool(workers=1, queue_size=1)
+    release = threading.Event()
+    threads = [threading.Thread(target=pool.apply, args=(release.wait,)) for i in range(2)]
+    for t in threads:
+        t.start()
+        time.sleep(0.1)
+    nt.assert_raises(PoolFull, pool.apply, lambda: None)
+    release.set()
+    for t in threads:
+        t.join()
+    nt.assert_equal(pool.get_stats()['rejected'], 1)
+
+def test_no_queue():
+    pool = WorkerPool(workers=1, queue_size=0)
+    release = threading.Event()
+    t = threading.Thread(target=pool.apply, args=(release.wait,))
+    t.start()
+    time.sleep(0.1)
+    nt.assert_raises(PoolFull, pool.apply, lambda: None)
+    release.set()
+    t.join()
+    time.sleep(0.1)
+    nt.assert_equal(pool.apply(lambda: 1), 1)
+
+def test_timeout():
+    pool = WorkerPool(workers=1, timeout=0.05)
+    nt.assert_raises(PoolTimeout, pool.apply, time.sleep, 0.2)
+    nt.assert_equal(pool.get_stats()['timeouts'], 1)
+
+def test_timeout_while_queued():
+    pool = WorkerPool(workers=1, timeout=0.1)
+    ran = []
+    release = threading.Event()
+    t = threading.Thread(target=lambda: nt.assert_raises(PoolTimeout, pool.apply, release.wait))
+    t.start()
+    time.sleep(0.05)
+    # the worker is busy, so this call times out before it starts
+    nt.assert_raises(PoolTimeout, pool.apply, ran.append, 'late')
+    release.set()
+    t.join()
+    time.sleep(0.1)
+    nt.assert_equal(ran, [])
+    nt.assert_equal(pool.get_stats()['queued'], 0)
+    nt.assert_equal(pool.apply(lambda: 1), 1)
+
+def test_iter_in_pool():
+    pool = WorkerPool(workers=1)
+    nt.assert_equal(list(iter_in_pool(pool, iter(range(250)), chunk_size=100)), range(250))
+    nt.assert_equal(list(iter_in_pool(pool, iter(range(5)), chunk=[-1])), [-1] + range(5))
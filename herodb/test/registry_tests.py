@@ -0,0 +1,72 @@
+from herodb.registry import StoreRegistry
+from nose import tools as nt
+import threading
+import time
+
+class FakeStore(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def _use(registry, key):
+    store = registry.acquire(key, lambda: FakeStore(key))
+    registry.release(store)
+    return store
+
+def test_eviction():
+    registry = StoreRegistry(max_stores=2)
+    a = _use(registry, 'a')
+    b = _use(registry, 'b')
+    nt.assert_true(_use(registry, 'a') is a)
+    _use(registry, 'c')
+    nt.assert_true(b.closed)
+    nt.assert_false(a.closed)
+    nt.assert_true('b' not in registry)
+    _use(registry, 'b')
+    nt.assert_true(a.closed)
+    nt.assert_equal(registry.get_stats(), {'open': 2, 'leased': 0, 'hits': 1, 'opened': 4, 'reopened': 1, 'evicted': 2})
+
+def test_single_open():
+    registry = StoreRegistry()
+    opened = []
+    def open_store():
+        opened.append(1)
+        time.sleep(0.1)
+        return FakeStore('a')
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.acquire('a', open_store))) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    nt.assert_equal(len(opened), 1)
+    nt.assert_equal(len(set(results)), 1)
+
+def test_close_idle():
+    registry = StoreRegistry()
+    a = _use(registry, 'a')
+    time.sleep(0.1)
+    b = _use(registry, 'b')
+    nt.assert_equal(registry.close_idle(0.05), 1)
+    nt.assert_true(a.closed)
+    nt.assert_false(b.closed)
+
+def test_leased_store_closed_on_release():
+    registry = StoreRegistry(max_stores=1)
+    a = registry.acquire('a', lambda: FakeStore('a'))
+    registry.acquire('a', lambda: FakeStore('a'))
+    b = registry.acquire('b', lambda: FakeStore('b'))
+    nt.assert_true('a' not in registry)
+    nt.assert_false(a.closed)
+    registry.release(a)
+    nt.assert_false(a.closed)
+    registry.release(a)
+    nt.assert_true(a.closed)
+    registry.release(b)
+    nt.assert_false(b.closed)
+    nt.assert_equal(registry.close_idle(0), 1)
+    nt.assert_true(b.closed)
@@ -0,0 +1,83 @@
+from herodb.scheduler import GcScheduler
+from herodb.store import _repo_state
+from nose import tools as nt
+import os
+import shutil
+import threading
+import time
+
+TEST_DIR = "/tmp/test_scheduler"
+
+class FakeStore(object):
+
+    def __init__(self, name, loose=0, writes=0, last_write=0):
+        self.name = name
+        self.gcs = []
+        # the scheduler ranks stores by what it finds on disk and in the shared repo
+        # state, so the fake store sets both up
+        objects = os.path.join(repo_path(name), 'objects', 'ab')
+        os.makedirs(objects)
+        for i in range(loose):
+            open(os.path.join(objects, '%038d' % i), 'w').close()
+        state = _repo_state(repo_path(name))
+        state.writes = writes
+        state.last_write = last_write
+
+    def gc(self):
+        self.gcs.append(threading.current_thread().name)
+
+    def close(self):
+        pass
+
+def repo_path(name):
+    return os.path.join(TEST_DIR, '%s.git' % name)
+
+def setUp():
+    if os.path.exists(TEST_DIR):
+        shutil.rmtree(TEST_DIR)
+
+@nt.with_setup(setup=setUp)
+def test_ranking():
+    stores = {
+        'a': FakeStore('a', loose=10),
+        'b': FakeStore('b', loose=5, writes=20),
+        'c': FakeStore('c', loose=1),
+    }
+    scheduler = GcScheduler(lambda: stores.keys(), stores.get, repo_path, stagger=0)
+    nt.assert_equal(scheduler.schedule(), ['b', 'a', 'c'])
+    # writes only count since the previous cycle
+    nt.assert_equal(scheduler.schedule(), ['a', 'b', 'c'])
+
+@nt.with_setup(setup=setUp)
+def test_staggered_runs():
+    stores = dict((name, FakeStore(name)) for name in 'abcd')
+    scheduler = GcScheduler(lambda: stores.keys(), stores.get, repo_path, workers=2, interval=3600, stagger=0.1)
+    start = time.time()
+    scheduler.schedule()
+    _start_workers(scheduler)
+    scheduler.queue.join()
+    nt.assert_true(time.time() - start >= 0.3)
+    nt.assert_equal(scheduler.get_stats()['runs'], 4)
+    for store in stores.values():
+        nt.assert_equal(len(store.gcs), 1)
+
+@nt.with_setup(setup=setUp)
+def test_busy_store_deferred():
+    busy = FakeStore('busy', last_write=time.time() + 3600)
+    idle = FakeStore('idle')
+    stores = {'busy': busy, 'idle': idle}
+    scheduler = GcScheduler(lambda: stores.keys(), stores.get, repo_path, workers=1, stagger=0, busy_window=0.05, max_defers=2)
+    scheduler.schedule()
+    _start_workers(scheduler)
+    scheduler.queue.join()
+    nt.assert_equal(busy.gcs, [])
+    nt.assert_equal(len(idle.gcs), 1)
+    stats = scheduler.get_stats()
+    nt.assert_equal(stats['deferred'], 2)
+    nt.assert_equal(stats['skipped'], 1)
+
+def _start_workers(scheduler):
+    for i in range(scheduler.workers):
+        t = threading.Thread(target=scheduler._work)
+        t.setDaemon(True)
+        t.start()
@@ -1,8 +1,13 @@
 import types
+import base64
+import json
+import requests
 from requests.exceptions import HTTPError
 from herodb.client import StoreClient
 from herodb.test.util import run_server, stop_server
+from herodb.store import encode_cursor
 from nose import tools as nt
+import threading
 import time
 
 client = None
@@ -14,6 +19,34 @@ def setup_hero():
     client = StoreClient('http://localhost:8081', 'test')
     client.create_store('test')
 
+def setup_threaded_hero():
+    global client
+    run_server('threaded', server_workers=4)
+    time.sleep(1)
+    client = StoreClient('http://localhost:8081', 'test')
+    client.create_store('test')
+
+def setup_group_commit_hero():
+    global client
+    run_server('threaded', server_workers=4, group_commit=True)
+    time.sleep(1)
+    client = StoreClient('http://localhost:8081', 'test')
+    client.create_store('test')
+
+def setup_gevent_hero():
+    global client
+    run_server('gevent', server_workers=4)
+    time.sleep(1)
+    client = StoreClient('http://localhost:8081', 'test')
+    client.create_store('test')
+
+def setup_prefork_hero():
+    global client
+    run_server('prefork', processes=2, server_workers=4)
+    time.sleep(2)
+    client = StoreClient('http://localhost:8081', 'test')
+    client.create_store('test')
+
 def teardown_hero():
     global client
     stop_server()
@@ -52,6 +85,25 @@ def test_put_many():
     nt.assert_equal(client.get('test', "a/b/x"), 1)
     nt.assert_equal(client.get('test', "a/b/y"), 2)
 
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_batch_put():
+    client.put('test', 'a', {'x': 1, 'y': 2})
+    sha = client.put_many('test', {'a/z': 3, 'b': {'c': 4}}, deletes=['a/x'])
+    nt.assert_equal(sha['sha'], client.get_branch('test', 'master')['sha'])
+    nt.assert_raises(HTTPError, client.get, 'test', 'a/x')
+    nt.assert_equal(client.get('test', 'a/y'), 2)
+    nt.assert_equal(client.get('test', 'a/z'), 3)
+    nt.assert_equal(client.get('test', 'b/c'), 4)
+
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_repack():
+    client.put('test', 'a', {'x': 1})
+    counts = client.object_counts('test')
+    nt.assert_true(counts['loose'] > 0)
+    nt.assert_equal(client.repack('test'), {'packed': counts['loose']})
+    nt.assert_equal(client.object_counts('test'), {'loose': 0, 'packs': 1})
+    nt.assert_equal(client.get('test', 'a/x'), 1)
+
 @nt.with_setup(setup=setup_hero, teardown=teardown_hero)
 def test_trees():
     sha = client.put('test', 'foo', 'foo')
@@ -91,6 +143,138 @@ def test_serialization():
     nt.assert_equal(type(d), types.DictType)
     nt.assert_equal(d, entries)
 
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_streaming():
+    client.put('test', 'a', {'x': 1, 'y': {'z': 2}})
+    keys = client.iter_keys('test', filter_by='blob')
+    nt.assert_equal(sorted(keys), ['a/x', 'a/y/z'])
+    entries = client.iter_entries('test', 'a/y')
+    nt.assert_equal(list(entries), [('a/y/z', 2)])
+    nt.assert_equal(sorted(client.iter_entries('test')), sorted(map(tuple, client.entries('test')['entries'])))
+
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_pagination():
+    client.put('test', 'a', {'x': 1, 'y': {'z': 2, 'w': 3}})
+    all_entries = client.entries('test')['entries']
+    entries = []
+    page = client.entries('test', limit=2)
+    while True:
+        entries.extend(page['entries'])
+        if not page['next']:
+            break
+        page = client.entries('test', limit=2, after=page['next'])
+    nt.assert_equal(entries, all_entries)
+    page = client.keys('test', limit=1)
+    nt.assert_equal(client.keys('test', after=page['next'])['keys'], client.keys('test')['keys'][1:])
+
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_bad_cursors():
+    client.put('test', 'a', {'x': 1, 'y': 2})
+    sha = client.get_branch('test', 'master')['sha']
+    missing = encode_cursor(sha, 'a/z')
+    not_strings = base64.urlsafe_b64encode(json.dumps([1, 2]))
+    for after in (missing, not_strings):
+        with nt.assert_raises(HTTPError) as cm:
+            client.keys('test', after=after)
+        nt.assert_equal(cm.exception.response.status_code, 400)
+        for route in ('keys', 'entries'):
+            r = requests.get('http://localhost:8081/test/%s' % route, params={'after': after, 'format': 'ndjson'})
+            nt.assert_equal(r.status_code, 400)
+    r = requests.get('http://localhost:8081/test/keys', params={'after': client.keys('test', limit=1)['next'], 'depth_first': 0})
+    nt.assert_equal(r.status_code, 400)
+
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_diff():
+    old = client.put('test', 'a', {'x': 1, 'y': 2})['sha']
+    client.put('test', 'a/x', 10)
+    new = client.delete('test', 'a/y')['sha']
+    client.put('test', 'b', 3)
+    d = client.diff('test', old, new)['diff']
+    nt.assert_equal(d['modify'], [[['a/x', 10]]])
+    nt.assert_equal(d['delete'], [[['a/y', None]]])
+    nt.assert_true('add' not in d)
+    changes = sorted(client.iter_diff('test', old))
+    nt.assert_equal(changes, [('add', 'b', 3), ('delete', 'a/y', None), ('modify', 'a/x', 10)])
+
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_changes():
+    since = client.get_branch('test', 'master')['sha']
+    # the single threaded server answers at once instead of blocking on the poll
+    start = time.time()
+    change = client.changes('test', since, timeout=10)
+    nt.assert_true(time.time() - start < 5)
+    nt.assert_equal(change, {'sha': since, 'diff': {}})
+    sha = client.put('test', 'a', {'x': 1})['sha']
+    change = client.changes('test', since, timeout=10)
+    nt.assert_equal(change['sha'], sha)
+    nt.assert_equal(change['diff']['add'], [[['a/x', 1]]])
+    change = next(client.watch('test', since))
+    nt.assert_equal(change['sha'], sha)
+
+@nt.with_setup(setup=setup_threaded_hero, teardown=teardown_hero)
+def test_threaded_server():
+    check_concurrent_requests()
+
+@nt.with_setup(setup=setup_group_commit_hero, teardown=teardown_hero)
+def test_group_commit_server():
+    nt.assert_equal(client.get_commit_stats(), {'enabled': True, 'commits': 0, 'writes': 0, 'pending': 0})
+    threads = [threading.Thread(target=client.put, args=('test', 'k%d' % i, {'i': i + 1})) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i in range(8):
+        nt.assert_equal(client.get('test', 'k%d/i' % i), i + 1)
+    stats = client.get_commit_stats()
+    nt.assert_equal(stats['writes'], 8)
+    nt.assert_true(1 <= stats['commits'] <= 8)
+    nt.assert_equal(stats['pending'], 0)
+
+@nt.with_setup(setup=setup_gevent_hero, teardown=teardown_hero)
+def test_gevent_server():
+    check_concurrent_requests()
+
+@nt.with_setup(setup=setup_prefork_hero, teardown=teardown_hero)
+def test_prefork_server():
+    check_concurrent_requests()
+    # stores are owned by different workers, but every worker sees every write
+    for store in ['a', 'b', 'c', 'd']:
+        client.create_store(store)
+        for i in range(1, 4):
+            sha = client.put(store, 'k', {'i': i})['sha']
+            for j in range(4):
+                nt.assert_equal(client.get_branch(store, 'master')['sha'], sha)
+                nt.assert_equal(client.get(store, 'k/i'), i)
+
+def check_concurrent_requests():
+    since = client.get_branch('test', 'master')['sha']
+    changes = []
+    watcher = threading.Thread(target=lambda: changes.append(client.changes('test', since, timeout=10)))
+    watcher.start()
+    time.sleep(0.2)
+    start = time.time()
+    sha = client.put('test', 'a', {'x': 1})['sha']
+    watcher.join()
+    nt.assert_true(time.time() - start < 5)
+    nt.assert_equal(changes[0]['sha'], sha)
+    nt.assert_equal(client.get('test', 'a/x'), 1)
+    nt.assert_equal(sorted(client.iter_keys('test')), ['a', 'a/x'])
+    nt.assert_equal(client.get_pool_stats()['workers'], 4)
+    # long-polls don't hold the workers other requests need
+    since = client.get_branch('test', 'master')['sha']
+    polls = [StoreClient('http://localhost:8081', 'test') for i in range(6)]
+    pollers = [threading.Thread(target=c.changes, args=('test', since), kwargs={'timeout': 3}) for c in polls]
+    for t in pollers:
+        t.setDaemon(True)
+        t.start()
+    time.sleep(0.5)
+    start = time.time()
+    nt.assert_equal(client.get('test', 'a/x'), 1)
+    nt.assert_true(time.time() - start < 1)
+    nt.assert_equal(client.get_pool_stats()['long_polls']['queued'], 0)
+    for t in pollers:
+        t.join()
+
 @nt.with_setup(setup=setup_hero, teardown=teardown_hero)
 def test_sparse_trees():
     sha = client.put('test', 'a/1', {'x': 1})
@@ -111,6 +295,9 @@ def test_sparse_trees():
     nt.assert_true('1' in t['a'])
     nt.assert_true('x' in t['a']['1'])
     nt.assert_true('b' not in t)
+    t = client.trees('test', glob='b/*')
+    nt.assert_true('a' not in t)
+    nt.assert_equal(t['b']['1']['x'], 3)
     t = client.trees('test', pattern='a', max_level=1)
     nt.assert_true('a' not in t)
     t = client.trees('test', pattern='a', max_level=2)
@@ -154,6 +341,20 @@ def test_branch_merge():
     sha = client.merge('test', 'b3')
     nt.assert_equal(sha['sha'], client.get_branch('test', 'master')['sha'])
 
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_merge_conflict():
+    client.put('test', 'a', 1)
+    client.create_branch('test', 'b1')
+    client.put('test', 'a', 2, branch='b1')
+    client.put('test', 'a', 3)
+    with nt.assert_raises(HTTPError) as cm:
+        client.merge('test', 'b1', on_conflict='fail')
+    nt.assert_equal(cm.exception.response.status_code, 409)
+    nt.assert_equal([c['key'] for c in cm.exception.response.json()['conflicts']], ['a'])
+    result = client.merge('test', 'b1')
+    nt.assert_equal(result['sha'], client.get_branch('test', 'master')['sha'])
+    nt.assert_equal(client.get('test', 'a'), 2)
+
 @nt.with_setup(setup=setup_hero, teardown=teardown_hero)
 def test_sparse_puts():
     sha = client.put('test', 'a', {'x': 1, 'y': 2, 'z': {'a': 1}})
@@ -197,38 +398,38 @@ def test_server_caching():
     # get
     verify_cache_stats(client.get_cache_stats(), 0, 0, 0)
     client.get('test', 'foo')
-    verify_cache_stats(client.get_cache_stats(), 1, 0, 0)
+    verify_cache_stats(client.get_cache_stats(), 1, 0, 1)
     client.get('test', 'foo', commit_sha=sha['sha'])
-    verify_cache_stats(client.get_cache_stats(), 2, 0, 1)
+    verify_cache_stats(client.get_cache_stats(), 2, 1, 1)
     client.get('test', 'foo', commit_sha=sha['sha'])
-    verify_cache_stats(client.get_cache_stats(), 3, 1, 1)
+    verify_cache_stats(client.get_cache_stats(), 3, 2, 1)
     # keys
     client.reset_cache_stats()
     verify_cache_stats(client.get_cache_stats(), 0, 0, 0)
     client.keys('test')
-    verify_cache_stats(client.get_cache_stats(), 1, 0, 0)
+    verify_cache_stats(client.get_cache_stats(), 1, 0, 1)
     client.keys('test', commit_sha=sha['sha'])
-    verify_cache_stats(client.get_cache_stats(), 2, 0, 1)
+    verify_cache_stats(client.get_cache_stats(), 2, 1, 1)
     client.keys('test', commit_sha=sha['sha'])
-    verify_cache_stats(client.get_cache_stats(), 3, 1, 1)
+    verify_cache_stats(client.get_cache_stats(), 3, 2, 1)
     # entries
     client.reset_cache_stats()
     verify_cache_stats(client.get_cache_stats(), 0, 0, 0)
     client.entries('test')
-    verify_cache_stats(client.get_cache_stats(), 1, 0, 0)
+    verify_cache_stats(client.get_cache_stats(), 1, 0, 1)
     client.entries('test', commit_sha=sha['sha'])
-    verify_cache_stats(client.get_cache_stats(), 2, 0, 1)
+    verify_cache_stats(client.get_cache_stats(), 2, 1, 1)
     client.entries('test', commit_sha=sha['sha'])
-    verify_cache_stats(client.get_cache_stats(), 3, 1, 1)
+    verify_cache_stats(client.get_cache_stats(), 3, 2, 1)
     # trees
     client.reset_cache_stats()
     verify_cache_stats(client.get_cache_stats(), 0, 0, 0)
     client.trees('test')
-    verify_cache_stats(client.get_cache_stats(), 1, 0, 0)
+    verify_cache_stats(client.get_cache_stats(), 1, 0, 1)
     client.trees('test', commit_sha=sha['sha'])
-    verify_cache_stats(client.get_cache_stats(), 2, 0, 1)
+    verify_cache_stats(client.get_cache_stats(), 2, 1, 1)
     client.trees('test', commit_sha=sha['sha'])
-    verify_cache_stats(client.get_cache_stats(), 3, 1, 1)
+    verify_cache_stats(client.get_cache_stats(), 3, 2, 1)
 
 @nt.with_setup(setup=setup_hero, teardown=teardown_hero)
 def test_client_caching():
@@ -269,6 +470,28 @@ def test_client_caching():
     client.trees('test', commit_sha=sha['sha'])
     verify_cache_stats(client.get_local_cache_stats(), 3, 1, 1)
 
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_object_cache_stats():
+    client.cache.enabled = False
+    client.put('test', 'a', {'b': 1})
+    client.get('test', 'a/b')
+    client.get('test', 'a/b')
+    stats = client.get_cache_stats()['objects']
+    nt.assert_true(stats['hits'] > 0)
+    nt.assert_true(stats['size'] > 0)
+
+@nt.with_setup(setup=setup_hero, teardown=teardown_hero)
+def test_server_caching_branch_head():
+    client.cache.enabled = False
+    client.put('test', 'foo', 'bar')
+    client.reset_cache_stats()
+    nt.assert_equal(client.get('test', 'foo'), 'bar')
+    nt.assert_equal(client.get('test', 'foo'), 'bar')
+    verify_cache_stats(client.get_cache_stats(), 2, 1, 1)
+    client.put('test', 'foo', 'baz')
+    nt.assert_equal(client.get('test', 'foo'), 'baz')
+    verify_cache_stats(client.get_cache_stats(), 3, 1, 2)
+
 def verify_cache_stats(cache_stats, requests=None, hits=None, misses=None):
     if requests:
         nt.assert_equal(cache_stats['requests'], requests)
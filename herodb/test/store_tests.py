@@ -1,8 +1,13 @@
-from herodb.store import Store, create
+from herodb.store import Store, PathIndex, Glob, MergeConflict, create, _literal_prefix
+from dulwich.repo import Repo
+from dulwich.objects import Blob
 import os
 import shutil
+import stat
 from nose import tools as nt
 import types
+import threading
+import time
 import re
 
 TEST_REPO = "/tmp/test.git"
@@ -161,6 +166,36 @@ def test_branch_merge():
     sha = store.merge('b3')
     nt.assert_equal(sha['sha'], store.branch_head('master'))
 
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_three_way_merge():
+    store.put('a', {'x': 1, 'y': 2})
+    store.put('b', {'z': 3})
+    store.create_branch('b1')
+    store.put('a/x', 10, branch='b1')
+    store.put('c', 4, branch='b1')
+    store.put('a/y', 20)
+    store.delete('b/z')
+    untouched = store._get_object('b').id
+    result = store.merge('b1')
+    nt.assert_equal(result['conflicts'], [])
+    nt.assert_equal(store.get('a/x'), 10)
+    nt.assert_equal(store.get('a/y'), 20)
+    nt.assert_equal(store.get('b/z'), None)
+    nt.assert_equal(store.get('c'), 4)
+    nt.assert_equal(store._get_object('b').id, untouched)
+    store.put('a/x', 100, branch='b1')
+    store.put('a/x', 1000)
+    ours = store.branch_head('master')
+    nt.assert_raises(MergeConflict, store.merge, 'b1', on_conflict='fail')
+    nt.assert_equal(store.branch_head('master'), ours)
+    result = store.merge('b1', on_conflict='ours')
+    nt.assert_equal([c['key'] for c in result['conflicts']], ['a/x'])
+    nt.assert_equal(store.get('a/x'), 1000)
+    store.put('a/x', 5, branch='b1')
+    store.put('a/x', 6)
+    store.merge('b1')
+    nt.assert_equal(store.get('a/x'), 5)
+
 @nt.with_setup(setup=setUp, teardown=tearDown)
 def test_sparse_puts():
     sha = store.put('a', {'x': 1, 'y': 2, 'z': {'a': 1}})
@@ -197,6 +232,301 @@ def test_sparse_puts():
     nt.assert_true('a' in t['a']['z'])
     nt.assert_equal(t['a']['z']['a'], 1)
 
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_overwrite_single_commit():
+    store.put('a', dict(('k%d' % i, i) for i in range(50)))
+    head = store.branch_head('master')
+    sha = store.put('a', {'k1': 1, 'new': 2}, overwrite=True)
+    commit = store.repo[sha['sha']]
+    nt.assert_equal(commit.parents, [head])
+    nt.assert_true('Put a/new' in commit.message)
+    nt.assert_true('Put a/k1' not in commit.message)
+    nt.assert_true('Delete a/k2' in commit.message)
+    nt.assert_equal(sorted(store.keys('a', filter_by='blob')), ['a/k1', 'a/new'])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_overwrite_with_subtree():
+    store.put('doc', {'a': 1, 'x': 2})
+    store.put('doc', {'a': {'b': 3}}, overwrite=True)
+    nt.assert_equal(store.get('doc/a/b'), 3)
+    nt.assert_equal(sorted(store.keys('doc', filter_by='blob')), ['doc/a/b'])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_overwrite_without_flatten():
+    store.put('doc', {'x': 1, 'y': 2})
+    store.put('doc', {'z': 3}, flatten_keys=False, overwrite=True)
+    nt.assert_equal(store.get('doc'), {'z': 3})
+    nt.assert_equal(store.keys('doc', filter_by='blob'), ['doc'])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_put_many_replacing_root():
+    store.put('a', 1)
+    nt.assert_equal(store.get('a'), 1)
+    store.put_many({'c': 3}, deletes=[''])
+    nt.assert_equal(store.keys(filter_by='blob'), ['c'])
+    nt.assert_equal(store.get('a'), None)
+    nt.assert_equal(store.get('c'), 3)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_noop_put():
+    sha = store.put('a', {'x': 1, 'y': {'z': 2}})
+    nt.assert_equal(store.put('a', {'x': 1, 'y': {'z': 2}}), sha)
+    nt.assert_equal(store.put('a/x', 1), sha)
+    nt.assert_equal(store.put_many({'a/x': 1}, deletes=['missing']), sha)
+    nt.assert_equal(store.branch_head('master'), sha['sha'])
+    nt.assert_not_equal(store.put('a/x', 2), sha)
+    sha = store.put('a/x', 2, branch='b1')
+    nt.assert_equal(store.branch_head('b1'), sha['sha'])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_bulk_import():
+    store.put('a', {'x': 1, 'y': 2})
+    object_store = store.repo.object_store
+    loose = len(list(object_store._iter_loose_objects()))
+    entries = [('a/x', 10), ('b', {'0': 0, '1': 1})] + [('d/%d' % i, i % 10) for i in range(100)]
+    sha = store.bulk_import(iter(entries))
+    nt.assert_equal(sha['sha'], store.branch_head('master'))
+    nt.assert_equal(len(list(object_store._iter_loose_objects())), loose + 1)
+    nt.assert_equal(len([f for f in os.listdir(object_store.pack_dir) if f.endswith('.pack')]), 1)
+    nt.assert_equal(store.get('a/x'), 10)
+    nt.assert_equal(store.get('a/y'), 2)
+    nt.assert_equal(store.get('b/1'), 1)
+    nt.assert_equal(store.get('d/42'), 2)
+    nt.assert_equal(len(store.keys('d', filter_by='blob')), 100)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_bulk_import_unlocked_read():
+    def entries():
+        yield ('a/x', 1)
+        # a write made while the entries are still being read isn't blocked, and
+        # the import is applied on top of it
+        t = threading.Thread(target=store.put, args=('b', 2))
+        t.setDaemon(True)
+        t.start()
+        t.join(5)
+        nt.assert_false(t.is_alive())
+        yield ('a/y', 2)
+    store.bulk_import(entries())
+    nt.assert_equal(store.get('a/x'), 1)
+    nt.assert_equal(store.get('a/y'), 2)
+    nt.assert_equal(store.get('b'), 2)
+    with nt.assert_raises(ValueError):
+        store.bulk_import([('', 1)])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_repack():
+    store.put('a', {'x': 1, 'y': 2})
+    counts = store.object_counts()
+    nt.assert_equal(counts['packs'], 0)
+    nt.assert_equal(store.repack(threshold=counts['loose'] + 1), 0)
+    nt.assert_equal(store.repack(), counts['loose'])
+    nt.assert_equal(store.object_counts(), {'loose': 0, 'packs': 1})
+    nt.assert_equal(store.get('a/x'), 1)
+    store.put('a/x', 3)
+    nt.assert_equal(store.get('a/y'), 2)
+    nt.assert_equal(store.get('a/x'), 3)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_noop_put_after_repack():
+    doc = dict(('k%d' % i, i) for i in range(200))
+    sha = store.put('doc', doc)
+    store.repack()
+    nt.assert_equal(store.object_counts()['loose'], 0)
+    nt.assert_equal(store.put('doc', doc), sha)
+    nt.assert_equal(store.put_many({'doc/k1': 1, 'doc/k2': 2}), sha)
+    nt.assert_equal(store.object_counts()['loose'], 0)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_reopen():
+    store.put('a', 1)
+    other = Store('test', TEST_REPO)
+    nt.assert_true(other.lock is store.lock)
+    store.close()
+    sha = other.put('a', 2)
+    nt.assert_equal(store.branch_head('master'), sha['sha'])
+    nt.assert_equal(store.get('a'), 2)
+
+def _external_put(key, value):
+    # commits straight to the repo, as another process such as herodb_import would
+    repo = Repo(TEST_REPO)
+    root = repo[repo[repo.refs['refs/heads/master']].tree]
+    blob = Blob.from_string(store.serializer.dumps(value))
+    repo.object_store.add_object(blob)
+    root.add(key, stat.S_IFREG, blob.id)
+    repo.object_store.add_object(root)
+    return repo.do_commit(tree=root.id, message="Put %s" % key, ref='refs/heads/master')
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_external_writes():
+    store.put('a', 1)
+    sha = _external_put('b', 2)
+    nt.assert_equal(store.branch_head('master'), sha)
+    nt.assert_equal(store.get('b'), 2)
+    store.put('c', 3)
+    nt.assert_equal(sorted(store.keys(filter_by='blob')), ['a', 'b', 'c'])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_head_changed_during_write():
+    store.put('a', 1)
+    old = store.branch_head('master')
+    _external_put('b', 2)
+    # the external commit lands after this store has read the head
+    ref = 'refs/heads/master'
+    store._heads[ref] = (old, store._ref_stamp(ref))
+    sha = store.put('c', 3)
+    nt.assert_equal(store.branch_head('master'), sha['sha'])
+    nt.assert_equal(sorted(store.keys(filter_by='blob')), ['a', 'b', 'c'])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_batch_put():
+    store.put('a', {'x': 1, 'y': 2})
+    store.put('foo', 'foo')
+    head = store.branch_head('master')
+    sha = store.put_many({'a/z': 3, 'b': {'c': 4}}, deletes=['a/x', 'foo', 'missing/key'])
+    nt.assert_equal(sha['sha'], store.branch_head('master'))
+    nt.assert_equal(store.repo[sha['sha']].parents, [head])
+    nt.assert_equal(store.get('a/x'), None)
+    nt.assert_equal(store.get('a/y'), 2)
+    nt.assert_equal(store.get('a/z'), 3)
+    nt.assert_equal(store.get('b/c'), 4)
+    nt.assert_equal(store.get('foo'), None)
+    nt.assert_equal(store.get('missing'), None)
+    sha = store.put_many({'a/w': 5}, deletes=['a'], branch='b1')
+    nt.assert_equal(sha['sha'], store.branch_head('b1'))
+    nt.assert_equal(store.get('a', branch='b1'), {'w': 5, 'commit_sha': sha['sha']})
+    nt.assert_equal(store.get('b/c', branch='b1'), 4)
+    nt.assert_equal(store.get('a/y'), 2)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_path_index():
+    store.put('a/b', {'c': 1, 'd': 2})
+    reads = []
+    def read_object(sha):
+        reads.append(sha)
+        return store.repo[sha]
+    head = store.branch_head('master')
+    index = PathIndex(read_object, store.repo[head].tree)
+    nt.assert_equal(index.lookup('a/b/c')[1], store._get_object('a/b/c').id)
+    nt.assert_equal(len(reads), 3)
+    index.lookup('a/b/c')
+    nt.assert_equal(len(reads), 3)
+    index.lookup('a/b/d')
+    nt.assert_equal(len(reads), 4)
+    nt.assert_raises(KeyError, index.lookup, 'a/x')
+    store._indexes[head] = index
+    sha = store.put('a/b/c', 3)
+    nt.assert_equal(store.get('a/b/c'), 3)
+    nt.assert_equal(store.get('a/b/d'), 2)
+    nt.assert_equal(store._indexes[sha['sha']].base, index)
+    store.delete('a/b/d')
+    nt.assert_equal(store.get('a/b/d'), None)
+    nt.assert_equal(store.get('a/b/c'), 3)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_value_cache():
+    store.put('a', {'x': [1, 2], 'y': [1, 2], 'z': 3})
+    nt.assert_equal(store.get('a/z'), 3)
+    hits = store.value_cache.hits
+    nt.assert_equal(store.get('a/z'), 3)
+    nt.assert_equal(store.value_cache.hits, hits + 1)
+    # in the default copy mode lists and dicts aren't cached, so callers can change them
+    nt.assert_equal(store.get('a/x'), [1, 2])
+    store.get('a/x').append(3)
+    nt.assert_equal(store.get('a/y'), [1, 2])
+    nt.assert_equal(store.get('a/x'), [1, 2])
+    nt.assert_equal(store.value_cache.hits, hits + 1)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_pagination():
+    store.put('a', {'x': 1, 'y': {'z': 2, 'w': 3}})
+    store.put('b', {'c': 4})
+    store.put('d', 5)
+    all_keys = store.keys()
+    head = store.branch_head('master')
+    keys = []
+    after = None
+    while True:
+        page = store.keys(limit=2, after=after)
+        keys.extend(page)
+        if len(page) < 2:
+            break
+        after = store.make_cursor(page[-1], commit_sha=head)
+        # the scan stays on the commit the cursor was made for
+        store.put('a/v', 6)
+    nt.assert_equal(keys, all_keys)
+    entries = list(store.entries(commit_sha=head))
+    page = list(store.entries(limit=1, after=store.make_cursor(entries[0][0], commit_sha=head)))
+    nt.assert_equal(page, entries[1:2])
+    nt.assert_raises(ValueError, store.keys, after='not a cursor')
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_pruned_traversal():
+    store.put('users', {'1': {'profile': {'name': 'a'}, 'other': 1}, '42': {'profile': {'name': 'b'}}})
+    store.put('groups', {'1': {'profile': {'name': 'c'}}})
+    nt.assert_equal(sorted(store.keys(pattern=re.compile('users/4'), filter_by='blob')), ['users/42/profile/name'])
+    nt.assert_equal(sorted(store.keys(pattern=Glob('users/*/profile'), filter_by='blob')),
+                    ['users/1/profile/name', 'users/42/profile/name'])
+    nt.assert_equal(store.trees(pattern=Glob('*/1/other')), {'users': {'1': {'other': 1}}})
+    users_sha = store._get_object('users').id
+    groups_sha = store._get_object('groups').id
+    visited = []
+    read_object = store._read_object
+    def _read_object(sha):
+        visited.append(sha)
+        return read_object(sha)
+    store._read_object = _read_object
+    store.keys(pattern=re.compile('groups/'))
+    nt.assert_true(users_sha not in visited)
+    nt.assert_true(groups_sha in visited)
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_keys_skip_blobs():
+    store.put('a', {'x': 'x' * 1000, 'y': {'z': 'z' * 1000}})
+    blobs = set([store._get_object('a/x').id, store._get_object('a/y/z').id])
+    visited = []
+    read_object = store._read_object
+    def _read_object(sha):
+        visited.append(sha)
+        return read_object(sha)
+    store._read_object = _read_object
+    nt.assert_equal(sorted(store.keys(filter_by='blob')), ['a/x', 'a/y/z'])
+    nt.assert_equal(sorted(store.keys(filter_by='tree')), ['a', 'a/y'])
+    nt.assert_equal(blobs.intersection(visited), set())
+    nt.assert_equal(store.keys('missing'), [])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_diff():
+    old = store.put('a', {'x': 1, 'y': 2, 'z': {'w': 3}})['sha']
+    store.put('a/x', 10)
+    store.delete('a/y')
+    mid = store.put('b', {'c': 4})['sha']
+    store.put('b/c', 5)
+    changes = sorted(store.iterdiff(old, mid))
+    nt.assert_equal(changes, [('add', 'b/c', 4), ('delete', 'a/y', None), ('modify', 'a/x', 10)])
+    d = store.diff(old)
+    nt.assert_equal(d['add'], [[('b/c', 5)]])
+    nt.assert_equal(d['delete'], [[('a/y', None)]])
+    nt.assert_equal(d['modify'], [[('a/x', 10)]])
+
+@nt.with_setup(setup=setUp, teardown=tearDown)
+def test_wait_for_change():
+    since = store.branch_head('master')
+    nt.assert_equal(store.wait_for_change(since, timeout=0.1), since)
+    results = []
+    t = threading.Thread(target=lambda: results.append(store.wait_for_change(since, timeout=10)))
+    t.start()
+    time.sleep(0.1)
+    sha = store.put('a', 1)['sha']
+    t.join(10)
+    nt.assert_equal(results, [sha])
+    nt.assert_equal(store.wait_for_change(since, timeout=10), sha)
+
+def test_literal_prefix():
+    nt.assert_equal(_literal_prefix(re.compile('users/42/.*')), 'users/42/')
+    nt.assert_equal(_literal_prefix(re.compile('^users/4?')), 'users/')
+    nt.assert_equal(_literal_prefix(re.compile('users|groups')), '')
+    nt.assert_equal(_literal_prefix(re.compile('users', re.I)), '')
+
 def check_type_and_value(v, ev, et):
     nt.assert_equal(type(v), et)
     nt.assert_equal(v, ev)
@@ -2,19 +2,25 @@ from multiprocessing import Process
 from threading import Thread
 import os
 
-def _run_server(loc, port):
+def _run_server(loc, port, server_mode, app_kwargs):
     from herodb import server
     if not os.path.exists(loc):
         os.makedirs(loc)
-    server.run(server.make_app(loc, gc_interval=0), quiet=True, port=port)
+    if server_mode == 'prefork':
+        from herodb import prefork
+        processes = app_kwargs.pop('processes', 2)
+        prefork.serve_prefork(loc, 'localhost', port, processes, quiet=True, gc_interval=0, **app_kwargs)
+        return
+    server.make_app(loc, gc_interval=0, server_mode=server_mode, **app_kwargs)
+    server.serve(port=port, server_mode=server_mode, quiet=True)
 
 server_process = None
 
-def run_server():
+def run_server(server_mode='wsgiref', **app_kwargs):
     global server_process
     os.system("rm -rf /tmp/unittest_herodb")
     os.mkdir("/tmp/unittest_herodb")
-    server_process = Process(target=_run_server, args=("/tmp/unittest_herodb", 8081))
+    server_process = Process(target=_run_server, args=("/tmp/unittest_herodb", 8081, server_mode, app_kwargs))
     server_process.daemon = True
     server_process.start()
 
@@ -3,7 +3,7 @@ setup(
     name = "herodb",
     version = "0.2.9",
     packages = find_packages(exclude="test"),
-	install_requires = ['dulwich>=0.8.3', 'bottle>=0.10.9', 'requests>=1.1.0'],
+	install_requires = ['dulwich>=0.19.16,<0.20', 'bottle>=0.10.9', 'requests>=1.1.0'],
 	setup_requires=['nose>=1.0'],
 	test_suite = 'nose.collector',
 	zip_safe = True,
@@ -16,6 +16,10 @@ setup(
 	keywords = "git key value store database",
 	url = "https://github.com/yieldbot/herodb",
     entry_points={
-        'console_scripts': ['herodb_mirror = herodb.mirror:mirror']
+        'console_scripts': [
+            'herodb_mirror = herodb.mirror:mirror',
+            'herodb_import = herodb.importer:import_store',
+            'herodb_server = herodb.server:main',
+        ]
     },
 )